@@ -0,0 +1,365 @@
+import argparse
+import heapq
+import json
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
+
+import pika
+
+from shared.connection_pool import ConnectionPool, backoff_delay
+from shared.memory_broker import MemoryBroker
+from shared.protocol import (
+    ACQUIRE, RELEASE, COMMITTED, REJECTED, CODECS_BY_NAME, DEFAULT_RESOURCE, EXCLUSIVE, SHARED, Message, get_codec, now_us
+)
+
+# Gerador de carga para o protocolo ACQUIRE/COMMITTED.
+# Cada processo hospeda vários clientes virtuais que enviam ACQUIREs no mesmo
+# formato do RabbitMQClient (Message + codec, reply_to e correlation_id) e
+# medem o tempo até o COMMITTED. Em malha fechada cada cliente virtual tem um
+# pedido em voo; em malha aberta os pedidos saem a uma taxa fixa,
+# independente das respostas.
+
+
+class RabbitMQTransport:
+    """Envia os pedidos para a r_queue de um RabbitMQ de verdade"""
+
+    def __init__(self, conf, codec, on_response, transport=None):
+        self.conf = conf
+        self.codec = codec
+        self.pool = ConnectionPool(
+            host=conf["host"],
+            port=conf["port"],
+            username=conf["username"],
+            password=conf["password"],
+            heartbeat=600,
+            transport=transport
+        )
+        self.connection = self.pool.connection()
+        self.channel = self.pool.acquire()
+        self.reply_queue = self.channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+        self.channel.basic_consume(
+            queue=self.reply_queue,
+            on_message_callback=lambda ch, method, props, body: on_response(props.correlation_id, props.content_type, body),
+            auto_ack=True
+        )
+        self.exchange = conf.get("exchange", "")
+
+    def send(self, message, correlation_id=None):
+        # Com um exchange de hash consistente, a routing key é o próprio recurso
+        routing_key = (message.resource or DEFAULT_RESOURCE) if self.exchange else self.conf["queue"]
+        self.channel.basic_publish(
+            exchange=self.exchange,
+            routing_key=routing_key,
+            properties=pika.BasicProperties(
+                reply_to=self.reply_queue if correlation_id else None,
+                correlation_id=correlation_id,
+                content_type=self.codec.content_type,
+                delivery_mode=2
+            ),
+            body=self.codec.encode(message)
+        )
+
+    def poll(self, timeout):
+        self.connection.process_data_events(time_limit=timeout)
+
+    def close(self):
+        self.pool.close()
+
+
+class MemoryTransport(RabbitMQTransport):
+    """O ClusterSync de verdade sobre o MemoryBroker, no mesmo processo dos clientes.
+
+    Sem rede: mede só a lógica de coordenação (e o custo do pika-like em memória).
+    """
+
+    def __init__(self, conf, codec, on_response):
+        # Módulo do cluster_sync: precisa de cluster_sync/src no PYTHONPATH
+        from cluster_sync import ClusterSync
+        broker = MemoryBroker()
+        self.sync = ClusterSync(transport=broker)
+        Thread(target=self.sync.run, name="cluster-sync", daemon=True).start()
+        super().__init__(conf, codec, on_response, transport=broker)
+
+
+class FakeTransport:
+    """Coordenador simulado no próprio processo, sem RabbitMQ.
+
+    Usa a mesma GrantQueue do cluster_sync (uma por recurso) e codifica e
+    decodifica cada mensagem como se ela tivesse passado pelo broker. A
+    seção crítica dura `hold` segundos, simulados por um heap de liberações.
+    """
+
+    def __init__(self, conf, codec, on_response, hold=0.0):
+        # Módulo do cluster_sync: precisa de cluster_sync/src no PYTHONPATH
+        from grant_queue import GrantQueue, PendingRequest
+        self.GrantQueue = GrantQueue
+        self.PendingRequest = PendingRequest
+        self.codec = codec
+        self.on_response = on_response
+        self.hold = hold
+        self.grant_queues = {}   # recurso -> GrantQueue
+        self.holders = {}        # recurso -> {request_id: modo} das concessões ativas
+        self.releases = []       # heap (instante, seq, recurso, pedido)
+        self.seq = 0
+
+    def send(self, message, correlation_id=None):
+        body = self.codec.encode(message)
+        codec = get_codec(self.codec.content_type)
+        msg = codec.decode(body)
+        if msg.type != ACQUIRE:
+            return  # A seção simulada já libera sozinha
+        resource = msg.resource or DEFAULT_RESOURCE
+        queue = self.grant_queues.get(resource)
+        if queue is None:
+            queue = self.grant_queues[resource] = self.GrantQueue()
+        queue.add(msg.request_id, self.PendingRequest(msg, None, correlation_id, codec))
+        self.schedule(resource)
+
+    def schedule(self, resource):
+        held = self.holders.get(resource)
+        batch = self.grant_queues[resource].grant_batch(next(iter(held.values())) if held else None)
+        if not batch:
+            return
+        holders = self.holders.setdefault(resource, {})
+        for request in batch:
+            holders[request.message.request_id] = request.message.mode
+            self.seq += 1
+            heapq.heappush(self.releases, (time.monotonic() + self.hold, self.seq, resource, request))
+
+    def poll(self, timeout):
+        if not self.releases or self.releases[0][0] > time.monotonic() + timeout:
+            time.sleep(timeout)
+            return
+        wait = self.releases[0][0] - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        now = time.monotonic()
+        while self.releases and self.releases[0][0] <= now:
+            _, _, resource, request = heapq.heappop(self.releases)
+            msg = request.message
+            self.grant_queues[resource].release(msg.request_id)
+            held = self.holders[resource]
+            del held[msg.request_id]
+            if not held:
+                del self.holders[resource]
+            self.schedule(resource)
+            committed = Message(COMMITTED, "fake_sync", now_us(), msg.request_id, msg.resource)
+            self.on_response(request.correlation_id, request.codec.content_type, request.codec.encode(committed))
+
+    def close(self):
+        pass
+
+
+TRANSPORTS = {"rabbitmq": RabbitMQTransport, "memory": MemoryTransport, "fake": FakeTransport}
+
+
+class VirtualClients:
+    """Os clientes virtuais de um processo, todos sobre um único transporte"""
+
+    def __init__(self, options, worker):
+        self.options = options
+        self.codec = CODECS_BY_NAME[options["codec"]]
+        self.client_ids = [f"bench_{worker}_{i}" for i in range(options["clients"])]
+        self.remaining = {client_id: options["requests"] for client_id in self.client_ids}
+        self.pending = {}      # correlation_id -> (client_id, instante do envio)
+        self.latencies = []
+        self.sent = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.retries = []      # heap (instante, seq, client_id, primeiro envio) dos recusados a reenviar
+        self.next_resource = 0
+
+        transport_class = TRANSPORTS[options["mode"]]
+        extra = {"hold": options["hold_ms"] / 1000} if options["mode"] == "fake" else {}
+        self.transport = transport_class(options["rabbitmq"], self.codec, self.on_response, **extra)
+
+    def resource(self):
+        # Distribui os pedidos entre os recursos em rodízio
+        resources = self.options["resources"]
+        if resources <= 1:
+            return self.options["resource"]
+        self.next_resource = (self.next_resource + 1) % resources
+        return f"{self.options['resource'] or DEFAULT_RESOURCE}_{self.next_resource}"
+
+    def send(self, client_id, sent_at=None):
+        """Envia um ACQUIRE; num reenvio, sent_at é o instante do primeiro envio"""
+        if sent_at is None:
+            sent_at = time.monotonic()
+            self.remaining[client_id] -= 1
+            self.sent += 1
+        mode = SHARED if random.random() < self.options["shared"] else EXCLUSIVE
+        message = Message(
+            ACQUIRE, client_id, now_us(), str(uuid.uuid4()), self.resource(), self.options["lease_ms"],
+            mode=mode
+        )
+        correlation_id = str(uuid.uuid4())
+        self.pending[correlation_id] = (client_id, sent_at)
+        self.transport.send(message, correlation_id)
+
+    def on_response(self, correlation_id, content_type, body):
+        pending = self.pending.pop(correlation_id, None)
+        if pending is None:
+            return
+        try:
+            response = get_codec(content_type).decode(body)
+        except ValueError:
+            return
+        client_id, sent_at = pending
+        if response.type == REJECTED:
+            # Reenvia depois do retry_after sugerido, com jitter
+            self.rejected += 1
+            retry_after = response.retry_after_ms / 1000
+            due = time.monotonic() + retry_after + backoff_delay(0, retry_after or 0.1, 10)
+            heapq.heappush(self.retries, (due, self.rejected, client_id, sent_at))
+            return
+        if response.type != COMMITTED:
+            return
+        self.latencies.append(time.monotonic() - sent_at)
+        if response.lease_ms:
+            # Concessão com lease: o cliente sai da seção logo em seguida
+            self.transport.send(Message(RELEASE, client_id, now_us(), response.request_id, response.resource))
+        if self.options["loop"] == "closed" and self.remaining[client_id] > 0:
+            self.send(client_id)
+
+    def resend_due(self):
+        now = time.monotonic()
+        while self.retries and self.retries[0][0] <= now:
+            _, _, client_id, sent_at = heapq.heappop(self.retries)
+            self.send(client_id, sent_at)
+
+    def expire(self):
+        now = time.monotonic()
+        expired = [cid for cid, (_, sent_at) in self.pending.items() if now - sent_at > self.options["timeout"]]
+        for correlation_id in expired:
+            client_id, _ = self.pending.pop(correlation_id)
+            self.timeouts += 1
+            if self.options["loop"] == "closed" and self.remaining[client_id] > 0:
+                self.send(client_id)
+
+    def run(self):
+        total = len(self.client_ids) * self.options["requests"]
+        started = time.time()
+        if self.options["loop"] == "closed":
+            for client_id in self.client_ids:
+                if self.remaining[client_id] > 0:
+                    self.send(client_id)
+        else:
+            interval = 1.0 / self.options["rate"]
+            next_send = time.monotonic()
+            index = 0
+            while self.sent < total:
+                now = time.monotonic()
+                while next_send <= now and self.sent < total:
+                    self.send(self.client_ids[index % len(self.client_ids)])
+                    index += 1
+                    next_send += interval
+                self.transport.poll(max(min(next_send - time.monotonic(), 0.1), 0))
+                self.resend_due()
+                self.expire()
+
+        while self.pending or self.retries:
+            self.transport.poll(0.1 if self.pending else max(self.retries[0][0] - time.monotonic(), 0))
+            self.resend_due()
+            self.expire()
+        finished = time.time()
+        self.transport.close()
+        return {
+            "started": started,
+            "finished": finished,
+            "sent": self.sent,
+            "committed": len(self.latencies),
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "latencies": self.latencies
+        }
+
+
+def run_worker(options, worker):
+    return VirtualClients(options, worker).run()
+
+
+def percentile(ordered, q):
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def report(results):
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    committed = sum(result["committed"] for result in results)
+    elapsed = max(r["finished"] for r in results) - min(r["started"] for r in results)
+    print(f"Pedidos enviados: {sum(r['sent'] for r in results)} | COMMITTED: {committed} | "
+          f"timeouts: {sum(r['timeouts'] for r in results)} | REJECTED: {sum(r['rejected'] for r in results)}")
+    print(f"Duração: {elapsed:.2f}s | Vazão: {committed / elapsed:.1f} concessões/s")
+    if latencies:
+        print("Latência ACQUIRE->COMMITTED: " + " ".join(
+            f"p{int(q * 100)}={percentile(latencies, q) * 1000:.2f}ms" for q in (0.50, 0.95, 0.99)
+        ))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description="Gerador de carga para o protocolo ACQUIRE/COMMITTED")
+    parser.add_argument("--mode", choices=sorted(TRANSPORTS), default="rabbitmq",
+                        help="rabbitmq (broker real), memory (ClusterSync sobre o MemoryBroker) "
+                             "ou fake (coordenador simulado no processo)")
+    parser.add_argument("--config", default=os.getenv("CONFIG_FILE", "../../client/config/client_config.json"),
+                        help="config de cliente de onde vêm o acesso ao RabbitMQ, o codec e o recurso")
+    parser.add_argument("--host", help="sobrescreve rabbitmq.host da config")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=10, help="clientes virtuais por processo")
+    parser.add_argument("--requests", type=int, default=100, help="pedidos por cliente virtual")
+    parser.add_argument("--loop", choices=("closed", "open"), default="closed")
+    parser.add_argument("--rate", type=float, default=100.0, help="pedidos/s por processo (malha aberta)")
+    parser.add_argument("--resources", type=int, default=1, help="quantidade de recursos distintos")
+    parser.add_argument("--codec", choices=sorted(CODECS_BY_NAME), help="sobrescreve o codec da config")
+    parser.add_argument("--lease-ms", type=int, default=0,
+                        help="pede concessões com lease; o RELEASE sai assim que chega o COMMITTED")
+    parser.add_argument("--shared", type=float, default=0.0,
+                        help="fração dos pedidos em modo compartilhado (leitura)")
+    parser.add_argument("--hold-ms", type=float, default=0.0, help="duração da seção crítica no modo fake")
+    parser.add_argument("--timeout", type=float, default=30.0, help="segundos até desistir de um pedido")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    rabbitmq = dict(config["rabbitmq"])
+    if args.host:
+        rabbitmq["host"] = args.host
+    return {
+        "mode": args.mode,
+        "rabbitmq": rabbitmq,
+        "processes": args.processes,
+        "clients": args.clients,
+        "requests": args.requests,
+        "loop": args.loop,
+        "rate": args.rate,
+        "resources": args.resources,
+        "resource": config.get("resource"),
+        "codec": args.codec or config.get("codec", "json"),
+        "lease_ms": args.lease_ms,
+        "shared": args.shared,
+        "hold_ms": args.hold_ms,
+        "timeout": args.timeout
+    }
+
+
+def main():
+    options = parse_options()
+    print(f"Modo {options['mode']}, malha {options['loop']}: {options['processes']} processo(s) x "
+          f"{options['clients']} clientes x {options['requests']} pedidos")
+    if options["processes"] == 1:
+        results = [run_worker(options, 0)]
+    else:
+        with ProcessPoolExecutor(max_workers=options["processes"]) as executor:
+            futures = [executor.submit(run_worker, options, worker) for worker in range(options["processes"])]
+            results = [future.result() for future in futures]
+    report(results)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nBenchmark interrompido pelo usuário")
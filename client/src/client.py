@@ -1,15 +1,38 @@
+import heapq
 import pika
 import json
 import uuid
 import random
 import time
 import os
-from datetime import datetime
+from shared.connection_pool import ConnectionPool, backoff_delay
+from shared.log import get_logger
+from shared.metrics import Registry, start_http_server
+from shared.protocol import (
+    ACQUIRE, RELEASE, RENEW, COMMITTED, REJECTED, CODECS_BY_NAME, DEFAULT_RESOURCE, EXCLUSIVE, LamportClock, Message, get_codec,
+    now_us
+)
+
+class InFlightRequest:
+    """Pedido ACQUIRE enviado e ainda sem COMMITTED"""
+
+    __slots__ = ("request_id", "attempt", "sent_at", "trace_id", "retries")
+
+    def __init__(self, request_id, attempt, sent_at, trace_id, retries=0):
+        self.request_id = request_id
+        self.attempt = attempt
+        self.sent_at = sent_at
+        self.trace_id = trace_id
+        self.retries = retries  # REJECTEDs já recebidos por este pedido
+
 
 class RabbitMQClient:
-    def __init__(self):
+    def __init__(self, transport=None):
         self.load_config()
-        self.setup_connection()
+        self.log = get_logger(self.CLIENT_ID)
+        self.check_config(self.CLIENT_ID)
+        self.setup_metrics()
+        self.setup_connection(transport)
         self.setup_queues()
         
     def load_config(self):
@@ -22,26 +45,57 @@ class RabbitMQClient:
         self.SLEEP_MIN = config["sleep_min"]
         self.SLEEP_MAX = config["sleep_max"]
         self.RABBITMQ_CONF = config["rabbitmq"]
+        self.CODEC = CODECS_BY_NAME[config.get("codec", "json")]  # json ou binary
+        self.RESOURCE = config.get("resource")  # None = seção crítica global
+        self.PIPELINE_DEPTH = config.get("pipeline_depth", 1)  # pedidos em voo
+        # Com lease > 0 o cliente mantém a seção crítica e envia RELEASE ao sair
+        self.LEASE_MS = config.get("lease_ms", 0)
+        self.PRIORITY = config.get("priority", 0)  # Classe de prioridade (maior = atendido antes)
+        self.MODE = config.get("mode", EXCLUSIVE)   # shared: leitura, concedida junto com outros leitores
         self.RESPONSE_TIMEOUT = 30  # segundos
+        # Após um REJECTED, espera o retry_after do cluster_sync mais um jitter
+        # exponencial e tenta de novo, até MAX_RETRIES vezes por pedido
+        self.MAX_RETRIES = config.get("max_retries", 5)
+        self.RETRY_BACKOFF_MAX = 10  # segundos
+        self.METRICS_PORT = config.get("metrics_port", 0)  # 0 = sem endpoint /metrics
+        # Respostas pela pseudo-fila amq.rabbitmq.reply-to, sem declarar fila própria
+        self.DIRECT_REPLY_TO = config.get("direct_reply_to", False)
+        self.pending = {}  # correlation_id -> pedido aguardando COMMITTED
+        self.rejected = {}  # correlation_id -> (pedido, espera) dos REJECTED recebidos
+        self.retries = []   # heap (instante, tentativa, REJECTEDs) dos pedidos a reenviar
+        self.latencies = []  # ACQUIRE -> COMMITTED, em segundos
+        self.clock = LamportClock()
+
+    def check_config(self, sender):
+        """Recusa na partida uma config que o codec não consegue codificar"""
+        self.CODEC.encode(Message(
+            ACQUIRE, sender, now_us(), str(uuid.uuid4()), self.RESOURCE, self.LEASE_MS,
+            0, self.PRIORITY, self.MODE
+        ))
 
-    def setup_connection(self):
-        credentials = pika.PlainCredentials(
-            self.RABBITMQ_CONF["username"], 
-            self.RABBITMQ_CONF["password"]
+    def setup_metrics(self):
+        self.metrics = Registry()
+        self.acquire_latency = self.metrics.histogram(
+            "client_acquire_commit_seconds", "Tempo do envio do ACQUIRE até o COMMITTED"
         )
-        
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=self.RABBITMQ_CONF["host"],
-                port=self.RABBITMQ_CONF["port"],
-                credentials=credentials,
-                heartbeat=600,
-                blocked_connection_timeout=300,
-                connection_attempts=5,
-                retry_delay=3
-            )
+        self.publish_latency = self.metrics.histogram("client_publish_seconds", "Duração do basic_publish")
+        self.timeouts = self.metrics.counter("client_timeouts_total", "Pedidos sem resposta no RESPONSE_TIMEOUT")
+        self.rejections = self.metrics.counter("client_rejected_total", "Pedidos recusados com REJECTED")
+        if self.METRICS_PORT:
+            start_http_server(self.metrics, self.METRICS_PORT)
+
+    def setup_connection(self, transport=None):
+        self.pool = ConnectionPool(
+            host=self.RABBITMQ_CONF["host"],
+            port=self.RABBITMQ_CONF["port"],
+            username=self.RABBITMQ_CONF["username"],
+            password=self.RABBITMQ_CONF["password"],
+            heartbeat=600,
+            blocked_connection_timeout=300,
+            transport=transport  # None = RabbitMQ; MemoryBroker = no próprio processo
         )
-        self.channel = self.connection.channel()
+        self.connection = self.pool.connection()
+        self.channel = self.pool.acquire()
 
     def setup_queues(self):
         """Configura as filas de forma segura, sem modificar existentes"""
@@ -54,6 +108,7 @@ class RabbitMQClient:
             )
         except pika.exceptions.ChannelClosedByBroker as e:
             if e.reply_code == 404:  # Se a fila não existir
+                self.channel = self.pool.acquire()  # O broker fecha o canal após o 404
                 self.channel.queue_declare(
                     queue=self.RABBITMQ_CONF["queue"],
                     durable=True,
@@ -65,14 +120,19 @@ class RabbitMQClient:
             else:
                 raise
         
-        # Fila de respostas (exclusiva para este cliente)
-        self.reply_queue = self.channel.queue_declare(
-            queue='',
-            exclusive=True,
-            auto_delete=True
-        )
-        self.reply_queue_name = self.reply_queue.method.queue
-        
+        if self.DIRECT_REPLY_TO:
+            # Direct reply-to: o RabbitMQ entrega as respostas direto neste canal.
+            # O consumo precisa começar antes do primeiro publish, com auto_ack
+            self.reply_queue_name = "amq.rabbitmq.reply-to"
+        else:
+            # Fila de respostas (exclusiva para este cliente)
+            self.reply_queue = self.channel.queue_declare(
+                queue='',
+                exclusive=True,
+                auto_delete=True
+            )
+            self.reply_queue_name = self.reply_queue.method.queue
+
         self.channel.basic_consume(
             queue=self.reply_queue_name,
             on_message_callback=self.on_response,
@@ -80,77 +140,236 @@ class RabbitMQClient:
         )
 
     def on_response(self, ch, method, props, body):
-        """Callback para processar respostas COMMITTED"""
-        if hasattr(self, 'current_correlation_id') and props.correlation_id == self.current_correlation_id:
-            try:
-                response = json.loads(body)
-                if response.get("status") == "COMMITTED":
-                    print(f"[{self.CLIENT_ID}] COMMITTED recebido para {props.correlation_id}")
-                    self.response_received = True
-            except json.JSONDecodeError:
-                print(f"[{self.CLIENT_ID}] Resposta inválida")
-
-    def send_request(self, attempt):
-        """Envia um pedido ACQUIRE para a fila"""
-        request_id = str(uuid.uuid4())
-        timestamp = datetime.utcnow().isoformat()
-        message = {
-            "client_id": self.CLIENT_ID,
-            "timestamp": timestamp,
-            "request_id": request_id,
-            "primitiva": "ACQUIRE"
-        }
+        """Callback para processar respostas COMMITTED (em qualquer ordem)"""
+        pending = self.pending.get(props.correlation_id)
+        if pending is None:
+            return  # Resposta atrasada de um pedido que já expirou
+        try:
+            response = get_codec(props.content_type).decode(body)
+            if response.type == COMMITTED:
+                self.clock.observe(response.clock)
+                del self.pending[props.correlation_id]
+                latency = time.monotonic() - pending.sent_at
+                self.latencies.append(latency)
+                self.acquire_latency.observe(latency)
+                self.log.debug(
+                    "COMMITTED recebido para %s (pedido %d)", pending.request_id, pending.attempt,
+                    extra={"fields": {"request_id": pending.request_id, "trace_id": pending.trace_id}}
+                )
+                if response.lease_ms and self.PIPELINE_DEPTH > 1:
+                    self.send_release(pending.request_id)  # Pipeline: libera logo em seguida
+            elif response.type == REJECTED:
+                del self.pending[props.correlation_id]
+                self.rejections.inc()
+                retry_after = response.retry_after_ms / 1000
+                delay = retry_after + backoff_delay(pending.retries, retry_after or 0.1, self.RETRY_BACKOFF_MAX)
+                self.rejected[props.correlation_id] = (pending, delay)
+                self.log.debug(
+                    "REJECTED para %s; nova tentativa em %.0fms", pending.request_id, delay * 1000,
+                    extra={"fields": {"request_id": pending.request_id, "trace_id": pending.trace_id}}
+                )
+        except ValueError:
+            self.log.warning("Resposta inválida")
+
+    def publish_message(self, message, **properties):
+        """Publica uma mensagem do protocolo para o cluster_sync"""
+        # Com um exchange de hash consistente, a routing key é o próprio recurso
+        exchange = self.RABBITMQ_CONF.get("exchange", "")
+        routing_key = (self.RESOURCE or DEFAULT_RESOURCE) if exchange else self.RABBITMQ_CONF["queue"]
+
+        started = time.monotonic()
+        self.channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            properties=pika.BasicProperties(
+                content_type=self.CODEC.content_type,
+                delivery_mode=2,  # Persistente
+                **properties
+            ),
+            body=self.CODEC.encode(message)
+        )
+        self.publish_latency.observe(time.monotonic() - started)
 
-        self.current_correlation_id = str(uuid.uuid4())
-        self.response_received = False
+    def send_request(self, attempt, retries=0):
+        """Envia um pedido ACQUIRE para a fila; retorna o correlation_id ou None"""
+        request_id = str(uuid.uuid4())
+        message = Message(
+            ACQUIRE, self.CLIENT_ID, now_us(), request_id, self.RESOURCE, self.LEASE_MS,
+            self.clock.tick(), self.PRIORITY, self.MODE
+        )
+        correlation_id = str(uuid.uuid4())
+        # Acompanha o pedido nos logs do cliente e do cluster_sync
+        trace_id = uuid.uuid4().hex
 
         try:
-            self.channel.basic_publish(
-                exchange=self.RABBITMQ_CONF.get("exchange", ""),
-                routing_key=self.RABBITMQ_CONF["queue"],
-                properties=pika.BasicProperties(
-                    reply_to=self.reply_queue_name,
-                    correlation_id=self.current_correlation_id,
-                    content_type='application/json',
-                    delivery_mode=2,  # Persistente
-                ),
-                body=json.dumps(message)
+            self.publish_message(
+                message,
+                reply_to=self.reply_queue_name,
+                correlation_id=correlation_id,
+                headers={"trace_id": trace_id}
+            )
+            self.pending[correlation_id] = InFlightRequest(request_id, attempt, time.monotonic(), trace_id, retries)
+            self.log.debug(
+                "Pedido %d enviado: %s", attempt, request_id,
+                extra={"fields": {"request_id": request_id, "trace_id": trace_id}}
             )
-            print(f"[{self.CLIENT_ID}] Pedido {attempt} enviado: {request_id}")
-            return True
+            return correlation_id
+        except (pika.exceptions.AMQPError, ValueError) as e:
+            self.log.error("Falha ao enviar pedido %d: %s", attempt, e)
+            return None
+
+    def send_release(self, request_id, sender=None):
+        try:
+            self.publish_message(Message(RELEASE, sender or self.CLIENT_ID, now_us(), request_id, self.RESOURCE))
+            self.log.debug("RELEASE enviado: %s", request_id)
         except pika.exceptions.AMQPError as e:
-            print(f"[{self.CLIENT_ID}] Falha ao enviar pedido {attempt}: {str(e)}")
-            return False
+            # O lease expira sozinho no cluster_sync
+            self.log.error("Falha ao enviar RELEASE: %s", e)
 
-    def wait_for_response(self):
+    def hold_section(self, request_id):
+        """Mantém a seção crítica concedida, renovando o lease na metade do prazo"""
+        deadline = time.monotonic() + random.uniform(0.2, 1.0)  # Simula processamento
+        renew_every = self.LEASE_MS / 2000
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.connection.sleep(min(remaining, renew_every))
+            if time.monotonic() < deadline:
+                renew = Message(RENEW, self.CLIENT_ID, now_us(), request_id, self.RESOURCE, self.LEASE_MS)
+                try:
+                    self.publish_message(renew)
+                except pika.exceptions.AMQPError as e:
+                    # Sem renovação o lease vai expirar: abandona a seção agora
+                    self.log.error("Falha ao renovar o lease de %s: %s", request_id, e)
+                    break
+        self.send_release(request_id)
+
+    def acquire(self, attempt):
+        """Pede a seção crítica até receber COMMITTED; retorna o request_id ou None"""
+        retries = 0
+        while True:
+            correlation_id = self.send_request(attempt, retries)
+            if correlation_id is None:
+                time.sleep(3)  # Espera antes de tentar novamente
+                return None
+            request_id = self.pending[correlation_id].request_id
+            if not self.wait_for_response(correlation_id):
+                return None
+            rejected = self.rejected.pop(correlation_id, None)
+            if rejected is None:
+                return request_id
+            if retries >= self.MAX_RETRIES:
+                self.log.warning("Pedido %d recusado %d vezes; desistindo", attempt, retries + 1)
+                return None
+            retries += 1
+            self.connection.sleep(rejected[1])
+
+    def wait_for_response(self, correlation_id):
         """Aguarda a resposta COMMITTED com timeout"""
-        start_time = time.time()
-        while not self.response_received:
-            if time.time() - start_time > self.RESPONSE_TIMEOUT:
-                print(f"[{self.CLIENT_ID}] Timeout esperando resposta")
+        deadline = time.monotonic() + self.RESPONSE_TIMEOUT
+        while correlation_id in self.pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                pending = self.pending.pop(correlation_id)
+                self.timeouts.inc()
+                self.log.warning(
+                    "Timeout esperando resposta", extra={"fields": {"trace_id": pending.trace_id}}
+                )
                 return False
-            self.connection.process_data_events()
-            time.sleep(0.1)
+            # Bloqueia no socket e retorna assim que a resposta é entregue
+            self.connection.process_data_events(time_limit=remaining)
         return True
 
+    def expire_pending(self):
+        """Descarta os pedidos em voo que passaram do RESPONSE_TIMEOUT"""
+        now = time.monotonic()
+        expired = [
+            correlation_id for correlation_id, pending in self.pending.items()
+            if now - pending.sent_at > self.RESPONSE_TIMEOUT
+        ]
+        for correlation_id in expired:
+            pending = self.pending.pop(correlation_id)
+            self.timeouts.inc()
+            self.log.warning(
+                "Timeout esperando resposta do pedido %d", pending.attempt,
+                extra={"fields": {"trace_id": pending.trace_id}}
+            )
+        return len(expired)
+
+    def schedule_retries(self):
+        """Agenda o reenvio dos pedidos recusados; retorna quantos foram abandonados"""
+        given_up = 0
+        now = time.monotonic()
+        for pending, delay in self.rejected.values():
+            if pending.retries >= self.MAX_RETRIES:
+                self.log.warning("Pedido %d recusado %d vezes; desistindo", pending.attempt, pending.retries + 1)
+                given_up += 1
+            else:
+                heapq.heappush(self.retries, (now + delay, pending.attempt, pending.retries + 1))
+        self.rejected.clear()
+        return given_up
+
+    def run_pipelined(self):
+        """Mantém até PIPELINE_DEPTH pedidos em voo, resolvidos fora de ordem"""
+        next_attempt = 1
+        finished = 0
+        while finished < self.ACCESS_COUNT:
+            # Reenvios vencidos têm preferência sobre pedidos novos
+            while len(self.pending) < self.PIPELINE_DEPTH and self.retries and self.retries[0][0] <= time.monotonic():
+                _, attempt, retries = heapq.heappop(self.retries)
+                if self.send_request(attempt, retries) is None:
+                    finished += 1
+            while len(self.pending) < self.PIPELINE_DEPTH and next_attempt <= self.ACCESS_COUNT:
+                if self.send_request(next_attempt) is None:
+                    finished += 1  # Falha de envio conta como pedido encerrado
+                next_attempt += 1
+
+            in_flight = len(self.pending)
+            time_limit = 1
+            if self.retries:
+                time_limit = min(max(self.retries[0][0] - time.monotonic(), 0), time_limit)
+            self.connection.process_data_events(time_limit=time_limit)
+            # Recusados saem de self.pending, mas só se encerram ao desistir
+            finished += in_flight - len(self.pending) - len(self.rejected)
+            finished += self.schedule_retries()
+            finished += self.expire_pending()
+
+    def report_latency(self):
+        """Imprime p50/p99 do tempo entre ACQUIRE e COMMITTED"""
+        if not self.latencies:
+            return
+        ordered = sorted(self.latencies)
+        p50 = ordered[int(0.50 * (len(ordered) - 1))]
+        p99 = ordered[int(0.99 * (len(ordered) - 1))]
+        self.log.info(
+            "Latência ACQUIRE->COMMITTED: p50=%.1fms p99=%.1fms (%d pedidos)", p50 * 1000, p99 * 1000, len(ordered)
+        )
+
     def run(self):
         """Executa o loop principal do cliente"""
         try:
+            if self.PIPELINE_DEPTH > 1:
+                self.run_pipelined()
+                self.log.info("Finalizou os %d pedidos.", self.ACCESS_COUNT)
+                self.report_latency()
+                return
+
             for i in range(1, self.ACCESS_COUNT + 1):
-                if not self.send_request(i):
-                    time.sleep(3)  # Espera antes de tentar novamente
+                request_id = self.acquire(i)
+                if request_id is None:
                     continue
-                    
-                if not self.wait_for_response():
-                    continue
-                    
+                if self.LEASE_MS:
+                    self.hold_section(request_id)
+
                 wait_time = random.randint(self.SLEEP_MIN, self.SLEEP_MAX)
-                print(f"[{self.CLIENT_ID}] Dormindo por {wait_time}s\n")
+                self.log.debug("Dormindo por %ds", wait_time)
                 time.sleep(wait_time)
 
-            print(f"[{self.CLIENT_ID}] Finalizou os {self.ACCESS_COUNT} pedidos.")
+            self.log.info("Finalizou os %d pedidos.", self.ACCESS_COUNT)
+            self.report_latency()
         finally:
-            self.connection.close()
+            self.pool.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,183 @@
+import os
+import random
+import time
+import uuid
+from functools import partial
+
+import pika
+
+from client import InFlightRequest, RabbitMQClient
+from shared.connection_pool import backoff_delay
+from shared.protocol import ACQUIRE, RENEW, COMMITTED, REJECTED, LamportClock, Message, get_codec, now_us
+
+# Hospeda vários client_ids lógicos em um só processo: uma conexão, um canal
+# e um único consumidor de respostas, com as respostas roteadas pelo
+# correlation_id. Cada cliente lógico repete o ciclo do RabbitMQClient
+# (ACQUIRE, COMMITTED, seção crítica, pausa), com os timers da conexão no
+# lugar dos sleeps, então centenas de clientes não custam centenas de
+# conexões e filas de resposta.
+#   CONFIG_FILE: config de cliente (client_id vira o prefixo dos ids lógicos)
+#   CLIENTS: quantidade de clientes lógicos (padrão 10)
+
+
+class LogicalClient:
+    """Estado de um client_id lógico hospedado no ClientHost"""
+
+    __slots__ = ("client_id", "clock", "remaining", "retries")
+
+    def __init__(self, client_id, access_count):
+        self.client_id = client_id
+        self.clock = LamportClock()
+        self.remaining = access_count
+        self.retries = 0  # REJECTEDs do pedido atual
+
+
+class ClientHost(RabbitMQClient):
+    def __init__(self, clients, transport=None):
+        started = time.monotonic()
+        super().__init__(transport)
+        self.clients = [LogicalClient(f"{self.CLIENT_ID}_{i}", self.ACCESS_COUNT) for i in range(clients)]
+        if self.clients:
+            self.check_config(self.clients[-1].client_id)  # o id lógico mais longo
+        self.in_flight = {}  # correlation_id -> (cliente lógico, pedido, timer do timeout)
+        self.active = len(self.clients)
+        self.log.info(
+            "%d clientes lógicos prontos em %.1fms", len(self.clients), (time.monotonic() - started) * 1000
+        )
+
+    def attempt(self, client):
+        return self.ACCESS_COUNT - client.remaining + 1
+
+    def send_acquire(self, client):
+        request_id = str(uuid.uuid4())
+        correlation_id = str(uuid.uuid4())
+        trace_id = uuid.uuid4().hex
+        message = Message(
+            ACQUIRE, client.client_id, now_us(), request_id, self.RESOURCE, self.LEASE_MS,
+            client.clock.tick(), self.PRIORITY, self.MODE
+        )
+        try:
+            self.publish_message(
+                message,
+                reply_to=self.reply_queue_name,
+                correlation_id=correlation_id,
+                headers={"trace_id": trace_id}
+            )
+        except (pika.exceptions.AMQPError, ValueError) as e:
+            self.log.error("Falha ao enviar pedido de %s: %s", client.client_id, e)
+            self.next_request(client)
+            return
+        request = InFlightRequest(request_id, self.attempt(client), time.monotonic(), trace_id, client.retries)
+        timer = self.connection.call_later(self.RESPONSE_TIMEOUT, partial(self.expire, correlation_id))
+        self.in_flight[correlation_id] = (client, request, timer)
+
+    def on_response(self, ch, method, props, body):
+        """Único consumidor de respostas: entrega ao cliente lógico dono do correlation_id"""
+        entry = self.in_flight.get(props.correlation_id)
+        if entry is None:
+            return  # Resposta atrasada de um pedido que já expirou
+        try:
+            response = get_codec(props.content_type).decode(body)
+        except ValueError:
+            self.log.warning("Resposta inválida")
+            return
+        if response.type not in (COMMITTED, REJECTED):
+            # Fica em voo: o timeout da resposta ainda segue para o próximo pedido
+            self.log.warning("Resposta inesperada: %s", response.type)
+            return
+        del self.in_flight[props.correlation_id]
+        client, request, timer = entry
+        self.connection.remove_timeout(timer)
+        fields = {"fields": {"client_id": client.client_id, "request_id": request.request_id,
+                             "trace_id": request.trace_id}}
+
+        if response.type == COMMITTED:
+            client.clock.observe(response.clock)
+            latency = time.monotonic() - request.sent_at
+            self.latencies.append(latency)
+            self.acquire_latency.observe(latency)
+            self.log.debug("COMMITTED recebido (pedido %d)", request.attempt, extra=fields)
+            if response.lease_ms:
+                self.schedule_hold(client, request.request_id)
+            else:
+                self.next_request(client)
+        elif response.type == REJECTED:
+            self.rejections.inc()
+            if client.retries >= self.MAX_RETRIES:
+                self.log.warning("Pedido recusado %d vezes; desistindo", client.retries + 1, extra=fields)
+                self.next_request(client)
+                return
+            retry_after = response.retry_after_ms / 1000
+            delay = retry_after + backoff_delay(client.retries, retry_after or 0.1, self.RETRY_BACKOFF_MAX)
+            client.retries += 1
+            self.connection.call_later(delay, partial(self.send_acquire, client))
+
+    def schedule_hold(self, client, request_id):
+        """Mantém a seção concedida por um tempo simulado, renovando o lease na metade do prazo"""
+        deadline = time.monotonic() + random.uniform(0.2, 1.0)
+        self.connection.call_later(
+            min(deadline - time.monotonic(), self.LEASE_MS / 2000),
+            partial(self.on_hold_timer, client, request_id, deadline)
+        )
+
+    def on_hold_timer(self, client, request_id, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self.send_release(request_id, client.client_id)
+            self.next_request(client)
+            return
+        try:
+            self.publish_message(Message(RENEW, client.client_id, now_us(), request_id, self.RESOURCE, self.LEASE_MS))
+        except pika.exceptions.AMQPError as e:
+            # Sem renovação o lease vai expirar: abandona a seção agora
+            self.log.error("Falha ao renovar o lease de %s: %s", client.client_id, e)
+            self.send_release(request_id, client.client_id)
+            self.next_request(client)
+            return
+        self.connection.call_later(
+            min(remaining, self.LEASE_MS / 2000), partial(self.on_hold_timer, client, request_id, deadline)
+        )
+
+    def expire(self, correlation_id):
+        entry = self.in_flight.pop(correlation_id, None)
+        if entry is None:
+            return
+        client, request, _ = entry
+        self.timeouts.inc()
+        self.log.warning(
+            "Timeout esperando resposta do pedido %d", request.attempt,
+            extra={"fields": {"client_id": client.client_id, "trace_id": request.trace_id}}
+        )
+        self.next_request(client)
+
+    def next_request(self, client):
+        """Encerra o pedido atual do cliente e agenda o próximo após a pausa"""
+        client.remaining -= 1
+        client.retries = 0
+        if client.remaining <= 0:
+            self.active -= 1
+            return
+        self.connection.call_later(random.randint(self.SLEEP_MIN, self.SLEEP_MAX), partial(self.send_acquire, client))
+
+    def run(self):
+        try:
+            for client in self.clients:
+                if client.remaining > 0:
+                    self.send_acquire(client)
+                else:
+                    self.active -= 1
+            while self.active:
+                self.connection.process_data_events(time_limit=1)
+            self.log.info("%d clientes finalizaram os %d pedidos.", len(self.clients), self.ACCESS_COUNT)
+            self.report_latency()
+        finally:
+            self.pool.close()
+
+if __name__ == "__main__":
+    try:
+        host = ClientHost(int(os.getenv("CLIENTS", "10")))
+        host.run()
+    except KeyboardInterrupt:
+        print("\nClient host encerrado pelo usuário")
+    except Exception as e:
+        print(f"Erro inesperado: {str(e)}")
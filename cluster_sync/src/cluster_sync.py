@@ -3,189 +3,728 @@ import json
 import time
 import random
 import os
-from threading import Thread
+from threading import Lock, Condition, Thread
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from grant_queue import GrantQueue, PendingRequest, RecentIds
+from publisher import OutboundPublisher
+from replication import LeaderLease, HEARTBEAT, ACQUIRE_EVENT, RELEASE_EVENT, SYNC_REQUEST, SYNC_STATE
+from wal import WriteAheadLog, ACQUIRE_RECORD, GRANT_RECORD, RELEASE_RECORD, encode_acquire
+from leases import LeaseTable
+from shared.connection_pool import ConnectionPool, backoff_delay
+from shared.log import get_logger
+from shared.messaging import BatchAcker
+from shared.metrics import Registry, start_http_server
+from shared.protocol import ACQUIRE, RELEASE, RENEW, COMMITTED, REJECTED, DEFAULT_RESOURCE, LamportClock, Message, get_codec, now_us
 
 class ClusterSync:
-    def __init__(self):
+    def __init__(self, transport=None):
         self.SYNC_ID = os.getenv("SYNC_ID", "sync_1")
-        self.setup_rabbitmq()
-        self.state = {
-            'acquire_list': [],
-            'release_list': [],
-            'pending_requests': []
-        }
-        print(f"[{self.SYNC_ID}] Iniciado e ouvindo a fila 'r_queue'")
-
-    def setup_rabbitmq(self):
+        self.log = get_logger(self.SYNC_ID)
+        self.setup_metrics()
+        self.setup_rabbitmq(transport)
+        # Uma fila de concessão por recurso; recursos diferentes não se bloqueiam.
+        # A fila é descartada quando fica vazia e sem concessões, então a
+        # memória acompanha os pedidos em aberto e não o histórico de recursos
+        self.grant_queues = {}   # recurso -> GrantQueue
+        self.recent = RecentIds()  # deduplicação de request_ids, comum a todas as filas
+        self.holders = {}        # recurso -> {request_id: modo} das concessões ativas
+        self.grant_lock = Lock()
+        # Ordem de concessão: prioridade, rodada de justiça por cliente e relógio
+        # de Lamport. CLIENT_WEIGHTS="client_1:1,client_2:2" dá a um cliente
+        # mais pedidos por rodada (padrão 1 para todos)
+        self.clock = LamportClock()
+        self.client_weights = {}
+        for item in filter(None, os.getenv("CLIENT_WEIGHTS", "").split(",")):
+            client_id, weight = item.split(":")
+            self.client_weights[client_id.strip()] = float(weight)
+        # Concessões compartilhadas permitidas enquanto um pedido exclusivo espera
+        self.shared_limit = int(os.getenv("SHARED_LIMIT", "64"))
+        # Controle de admissão: com a fila do recurso em MAX_PENDING pedidos ou a
+        # espera estimada acima de MAX_WAIT_MS, o ACQUIRE é recusado na hora com
+        # REJECTED em vez de esperar até o TTL da r_queue (0 = sem limite)
+        self.max_pending = int(os.getenv("MAX_PENDING", "0"))
+        self.max_wait = int(os.getenv("MAX_WAIT_MS", "0")) / 1000
+        self.retry_after_min = int(os.getenv("RETRY_AFTER_MS", "100")) / 1000
+        self.hold_estimate = 0.0  # média móvel do tempo de posse, em segundos
+        # Pool limitado que executa as seções críticas concedidas
+        self.workers = ThreadPoolExecutor(
+            max_workers=int(os.getenv("GRANT_WORKERS", "4")),
+            thread_name_prefix="grant"
+        )
+        # Toda concessão tem um lease; se ele vencer sem RELEASE/RENEW, o
+        # recurso é liberado e passa ao próximo da fila
+        self.leases = LeaseTable()
+        self.lease_cond = Condition(self.grant_lock)
+        self.grant_lease = int(os.getenv("GRANT_LEASE_MS", "30000")) / 1000
+        Thread(target=self.run_lease_reaper, name="lease-reaper", daemon=True).start()
+        # Com réplicas, só o líder (eleito por lease) consome a r_queue e concede;
+        # os seguidores mantêm uma cópia do estado a partir dos eventos do líder
+        self.lease = None
+        self.is_leader = True
+        self.consumer_tag = None
+        if self.events_exchange:
+            self.lease = LeaderLease(self.SYNC_ID, int(os.getenv("LEASE_TIMEOUT_MS", "2000")) / 1000)
+            self.heartbeat_interval = int(os.getenv("HEARTBEAT_INTERVAL_MS", "500")) / 1000
+            self.is_leader = False
+
+        # Log local de ACQUIRE/GRANT/RELEASE; reconstrói as filas ao reiniciar.
+        # Com o log, cada entrega só é confirmada ao broker depois do fsync
+        self.wal = None
+        wal_dir = os.getenv("WAL_DIR", "")
+        if wal_dir:
+            wal = WriteAheadLog(
+                wal_dir,
+                self.pending_requests,
+                segment_bytes=int(os.getenv("WAL_SEGMENT_BYTES", str(4 * 1024 * 1024))),
+                fsync_interval=int(os.getenv("WAL_FSYNC_MS", "50")) / 1000,
+                max_waiters=self.prefetch_count
+            )
+            self.restore(wal)
+            self.wal = wal
+            wal.start()
+        metrics_port = int(os.getenv("METRICS_PORT", "0"))
+        if metrics_port:
+            start_http_server(self.metrics, metrics_port)
+        self.log.info("Iniciado e ouvindo a fila '%s'", self.rabbitmq_queue)
+
+    def setup_metrics(self):
+        self.metrics = Registry()
+        self.queue_depth = self.metrics.gauge(
+            "sync_queue_depth", "Pedidos pendentes em todas as filas de concessão",
+            function=self.pending_count
+        )
+        self.messages = self.metrics.counter("sync_messages_total", "Mensagens recebidas na r_queue", ("type",))
+        self.grant_wait = self.metrics.histogram("sync_grant_wait_seconds", "Tempo do ACQUIRE até a concessão")
+        self.hold_time = self.metrics.histogram("sync_hold_seconds", "Tempo da concessão até o RELEASE")
+        self.publish_latency = self.metrics.histogram(
+            "sync_publish_latency_seconds", "Tempo até o broker confirmar uma publicação"
+        )
+        self.reconnect_count = self.metrics.counter("sync_reconnects_total", "Reconexões ao RabbitMQ")
+        self.expired_leases = self.metrics.counter("sync_expired_leases_total", "Leases vencidos sem RELEASE")
+        self.rejected = self.metrics.counter("sync_rejected_total", "ACQUIREs recusados pelo controle de admissão")
+
+    def setup_rabbitmq(self, transport=None):
         self.rabbitmq_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
         self.rabbitmq_user = os.getenv("RABBITMQ_USER", "Nicole")
         self.rabbitmq_pass = os.getenv("RABBITMQ_PASS", "nicole123")
         self.rabbitmq_queue = os.getenv("RABBITMQ_QUEUE", "r_queue")
+        # Destino das mensagens que nunca serão processadas (corpo inválido ou
+        # erro repetido). O DLX da r_queue ('' sem routing key) devolveria a
+        # mensagem à própria r_queue, então o desvio é feito aqui
+        self.dead_letter_queue = os.getenv("DEAD_LETTER_QUEUE", f"{self.rabbitmq_queue}.dead")
+        self.prefetch_count = int(os.getenv("PREFETCH_COUNT", "1"))
+        self.ack_batch_size = int(os.getenv("ACK_BATCH_SIZE", "1"))
+        self.ack_interval_ms = int(os.getenv("ACK_INTERVAL_MS", "0"))
+        # Exchange x-consistent-hash que distribui os recursos entre instâncias
+        # (vazio = clientes publicam direto na r_queue)
+        self.shard_exchange = os.getenv("SHARD_EXCHANGE", "")
+        # Exchange fanout da replicação entre instâncias (vazio = nó único)
+        self.events_exchange = os.getenv("SYNC_EVENTS_EXCHANGE", "")
+        if self.shard_exchange and self.events_exchange:
+            # A eleição é por nó, não por fila: as filas de shard dos
+            # seguidores ficariam sem consumidor
+            raise ValueError("SHARD_EXCHANGE e SYNC_EVENTS_EXCHANGE não podem ser usados juntos")
         
+        self.pool = ConnectionPool(
+            host=self.rabbitmq_host,
+            username=self.rabbitmq_user,
+            password=self.rabbitmq_pass,
+            heartbeat=600,
+            blocked_connection_timeout=300,
+            transport=transport  # None = RabbitMQ; MemoryBroker = no próprio processo
+        )
+        # Backoff do laço supervisor entre reconexões seguidas
+        self.reconnect_base = int(os.getenv("RECONNECT_BASE_MS", "100")) / 1000
+        self.reconnect_max = int(os.getenv("RECONNECT_MAX_MS", "5000")) / 1000
+        self.reconnects = 0
         self.connection = None
         self.channel = None
+        self.publisher = None
         self.connect()
 
     def connect(self):
-        max_retries = 5
-        retry_delay = 3
-        
-        for attempt in range(max_retries):
+        # As novas tentativas de conexão (com backoff e jitter) ficam com o pool
+        self.connection = self.pool.connection()
+        self.channel = self.pool.acquire()
+
+        # Configura a fila como durável
+        self.channel.queue_declare(
+            queue=self.rabbitmq_queue,
+            durable=True,
+            arguments={
+                'x-message-ttl': 60000,
+                'x-dead-letter-exchange': ''
+            }
+        )
+        self.channel.queue_declare(queue=self.dead_letter_queue, durable=True)
+
+        # Recebe a parte dos recursos que o hash consistente atribuir a esta fila
+        if self.shard_exchange:
+            self.channel.exchange_declare(
+                exchange=self.shard_exchange,
+                exchange_type='x-consistent-hash',
+                durable=True
+            )
+            # No x-consistent-hash a routing key do bind é o peso da fila
+            self.channel.queue_bind(
+                queue=self.rabbitmq_queue,
+                exchange=self.shard_exchange,
+                routing_key=os.getenv("SHARD_WEIGHT", "1")
+            )
+
+        # Fila exclusiva deste nó para receber os eventos das outras réplicas
+        if self.events_exchange:
+            self.channel.exchange_declare(
+                exchange=self.events_exchange,
+                exchange_type='fanout',
+                durable=True
+            )
+            result = self.channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+            self.events_queue = result.method.queue
+            self.channel.queue_bind(queue=self.events_queue, exchange=self.events_exchange)
+
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.acker = BatchAcker(
+            self.connection, self.channel,
+            self.prefetch_count, self.ack_batch_size, self.ack_interval_ms
+        )
+
+        # Publicações de outras threads passam pela fila do publisher
+        if self.publisher is None:
+            self.publisher = OutboundPublisher(self.connection, self.channel, latency=self.publish_latency)
+        else:
+            self.publisher.rebind(self.connection, self.channel)
+        return True
+
+    def run(self):
+        """Laço supervisor: consome até a conexão cair e reconecta com backoff.
+
+        É o único ponto que reconecta. As threads de concessão só enfileiram
+        publicações no OutboundPublisher, que reenvia o que o broker não
+        confirmou. Entregas sem ack voltam para a fila e são descartadas
+        pelo request_id, então nenhum pedido é concedido duas vezes.
+        """
+        failures = 0
+        while True:
+            started = time.monotonic()
             try:
-                credentials = pika.PlainCredentials(self.rabbitmq_user, self.rabbitmq_pass)
-                parameters = pika.ConnectionParameters(
-                    host=self.rabbitmq_host,
-                    credentials=credentials,
-                    heartbeat=600,
-                    blocked_connection_timeout=300,
-                    connection_attempts=3,
-                    retry_delay=3
-                )
-                
-                self.connection = pika.BlockingConnection(parameters)
-                self.channel = self.connection.channel()
-                
-                # Configura a fila como durável
-                self.channel.queue_declare(
-                    queue=self.rabbitmq_queue,
-                    durable=True,
-                    arguments={
-                        'x-message-ttl': 60000,
-                        'x-dead-letter-exchange': ''
-                    }
-                )
-                
-                self.channel.basic_qos(prefetch_count=1)
-                return True
-                
-            except Exception as e:
-                print(f"[{self.SYNC_ID}] Tentativa {attempt + 1}/{max_retries} - Erro ao conectar: {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-        
-        raise Exception("Não foi possível conectar ao RabbitMQ após várias tentativas")
+                if self.connection is None:
+                    self.connect()
+                self.start_consuming()
+                return  # stop_consuming(): encerramento normal
+            except pika.exceptions.AMQPError as e:
+                self.log.warning("Conexão perdida: %s", e)
 
-    def reconnect(self):
-        try:
-            if self.connection and self.connection.is_open:
-                self.connection.close()
-        except:
-            pass
-            
-        print(f"[{self.SYNC_ID}] Tentando reconectar...")
-        self.connect()
-        self.start_consuming()
+            self.pool.invalidate()
+            self.connection = None
+            self.consumer_tag = None
+            if self.lease is not None:
+                # Outro nó pode assumir enquanto este está desconectado: só
+                # volta a consumir a r_queue depois de uma nova eleição
+                self.lose_leadership()
+            self.reconnects += 1
+            self.reconnect_count.inc()
+            # Uma conexão que ficou de pé por um tempo zera o backoff: a
+            # primeira nova tentativa é imediata
+            if time.monotonic() - started > self.reconnect_max:
+                failures = 0
+            delay = backoff_delay(failures, self.reconnect_base, self.reconnect_max) if failures else 0
+            failures += 1
+            self.log.info("Reconectando em %.0fms (%d publicações pendentes)", delay * 1000, self.publisher.pending())
+            time.sleep(delay)
 
     def start_consuming(self):
-        try:
+        if self.is_leader:
+            self.consume_requests()
+        if self.events_exchange:
             self.channel.basic_consume(
-                queue=self.rabbitmq_queue,
-                on_message_callback=self.on_message,
-                auto_ack=False
+                queue=self.events_queue,
+                on_message_callback=self.on_event,
+                auto_ack=True
             )
-            print(f"[{self.SYNC_ID}] Aguardando mensagens...")
-            self.channel.start_consuming()
-        except pika.exceptions.AMQPError as e:
-            print(f"[{self.SYNC_ID}] Erro no consumo: {str(e)}")
-            self.reconnect()
-        except Exception as e:
-            print(f"[{self.SYNC_ID}] Erro inesperado: {str(e)}")
-            raise
+            # Pede ao líder os pedidos pendentes e começa a enviar heartbeats
+            self.publish_event(SYNC_REQUEST)
+            self.connection.call_later(self.heartbeat_interval, self.on_heartbeat_timer)
+        self.log.info("Aguardando mensagens...")
+        self.channel.start_consuming()
+
+    def consume_requests(self):
+        self.consumer_tag = self.channel.basic_consume(
+            queue=self.rabbitmq_queue,
+            on_message_callback=self.on_message,
+            auto_ack=False
+        )
 
     def on_message(self, ch, method, properties, body):
         try:
             if not body:
-                ch.basic_nack(delivery_tag=method.delivery_tag)
+                self.dead_letter(method, properties, body, "corpo vazio")
                 return
 
-            msg = json.loads(body.decode())
-            primitiva = msg.get("primitiva")
-            request_id = msg.get("request_id")
-
-            if primitiva == "ACQUIRE":
-                self.state['acquire_list'].append(msg)
-                msg["reply_to"] = properties.reply_to
-                msg["correlation_id"] = properties.correlation_id
-                self.state['pending_requests'].append(msg)
-                print(f"[{self.SYNC_ID}] ACQUIRE recebido de {msg['client_id']}")
-                
-                # Processa em thread separada para não bloquear
-                Thread(target=self.process_request, args=(msg,)).start()
-                
-            elif primitiva == "RELEASE":
-                self.state['release_list'].append(request_id)
-                print(f"[{self.SYNC_ID}] RELEASE registrado de {msg['client_id']}")
-
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            
-        except json.JSONDecodeError:
-            print(f"[{self.SYNC_ID}] Mensagem inválida (não JSON)")
-            ch.basic_nack(delivery_tag=method.delivery_tag)
+            # O codec é negociado pelo content_type de cada mensagem
+            codec = get_codec(properties.content_type)
+            msg = codec.decode(body)
+            trace_id = (properties.headers or {}).get("trace_id")
+            self.messages.labels(msg.type).inc()
+
+            if msg.type == ACQUIRE:
+                if msg.clock:
+                    self.clock.observe(msg.clock)
+                else:
+                    # Cliente sem relógio: carimba na chegada e replica o pedido já carimbado
+                    msg = msg._replace(clock=self.clock.tick())
+                    body = codec.encode(msg)
+                request = PendingRequest(msg, properties.reply_to, properties.correlation_id, codec, trace_id)
+                retry_after = self.admission(request)
+                if retry_after:
+                    self.rejected.inc()
+                    self.send_rejected(request, retry_after)
+                elif self.add_request(request) and self.events_exchange:
+                    # Replica o pedido reaproveitando o corpo já codificado
+                    self.publish_event(
+                        ACQUIRE_EVENT, body, codec.content_type,
+                        properties.reply_to, properties.correlation_id, trace_id
+                    )
+                self.log.debug(
+                    "ACQUIRE recebido de %s (%s)", msg.sender, msg.resource or DEFAULT_RESOURCE,
+                    extra={"fields": {"request_id": msg.request_id, "trace_id": trace_id}}
+                )
+
+            elif msg.type == RELEASE:
+                # RELEASEs externos repetidos são descartados pelo request_id
+                if self.release_request(msg.resource or DEFAULT_RESOURCE, msg.request_id):
+                    self.log.debug(
+                        "RELEASE registrado de %s", msg.sender,
+                        extra={"fields": {"request_id": msg.request_id, "trace_id": trace_id}}
+                    )
+
+            elif msg.type == RENEW:
+                if not self.renew_lease(msg):
+                    self.log.info(
+                        "RENEW ignorado: %s não detém %s", msg.request_id, msg.resource or DEFAULT_RESOURCE,
+                        extra={"fields": {"request_id": msg.request_id, "trace_id": trace_id}}
+                    )
+
+            self.ack(method.delivery_tag)
+
+        except ValueError as e:
+            # Falha determinística: reentregar só repetiria o erro
+            self.log.warning("Mensagem inválida: %s", e)
+            self.dead_letter(method, properties, body, str(e))
         except Exception as e:
-            print(f"[{self.SYNC_ID}] Erro ao processar mensagem: {str(e)}")
-            ch.basic_nack(delivery_tag=method.delivery_tag)
+            self.log.error("Erro ao processar mensagem: %s", e)
+            if method.redelivered:
+                # Já falhou numa entrega anterior: não volta mais para a fila
+                self.dead_letter(method, properties, body, str(e))
+            else:
+                self.acker.nack(method.delivery_tag)
+
+    def dead_letter(self, method, properties, body, reason):
+        """Tira a entrega da r_queue, guardando uma cópia na fila de mensagens mortas"""
+        headers = dict(properties.headers or {})
+        headers["x-death-reason"] = reason
+        self.publisher.publish(
+            exchange='',
+            routing_key=self.dead_letter_queue,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=properties.content_type,
+                reply_to=properties.reply_to,
+                correlation_id=properties.correlation_id,
+                headers=headers,
+                delivery_mode=2
+            )
+        )
+        self.ack(method.delivery_tag)
+
+    def ack(self, delivery_tag):
+        """Confirma a entrega; com o WAL, só depois do fsync dos registros dela"""
+        if self.wal is None:
+            self.acker.ack(delivery_tag)
+            return
+        # Todos os acks passam por aqui na ordem de entrega, então o
+        # multiple=True do BatchAcker nunca alcança uma entrega ainda não gravada
+        connection, acker = self.connection, self.acker
+        self.wal.after_flush(
+            lambda: connection.add_callback_threadsafe(partial(self.ack_durable, acker, delivery_tag))
+        )
+
+    def ack_durable(self, acker, delivery_tag):
+        # Entregas de uma conexão anterior já voltaram para a fila
+        if acker is self.acker:
+            acker.ack(delivery_tag)
 
-    def process_request(self, request):
+    def on_event(self, ch, method, properties, body):
+        """Eventos de replicação publicados pelas outras instâncias"""
+        if properties.app_id == self.SYNC_ID:
+            return  # O próprio nó já aplicou o evento localmente
+        headers = properties.headers or {}
+        self.lease.observe(properties.app_id, headers.get("leader", False), headers.get("term", 0))
+
+        if properties.type == HEARTBEAT:
+            return
+        if properties.type == SYNC_REQUEST:
+            if self.is_leader:
+                self.replicate_pending()
+            return
+        if properties.type == SYNC_STATE:
+            if headers.get("leader") and not self.is_leader:
+                self.reconcile(json.loads(body))
+            return
+
+        codec = get_codec(properties.content_type)
         try:
-            if self.can_enter_critical_section(request):
-                self.enter_critical_section(request)
-        except Exception as e:
-            print(f"[{self.SYNC_ID}] Erro no processamento: {str(e)}")
-
-    def can_enter_critical_section(self, request):
-        for acq in self.state['acquire_list']:
-            if acq["request_id"] == request["request_id"]:
-                return True
-            if acq["request_id"] not in self.state['release_list']:
-                return False
-        return True
+            msg = codec.decode(body)
+        except ValueError:
+            self.log.warning("Evento inválido de %s", properties.app_id)
+            return
+        if properties.type == ACQUIRE_EVENT:
+            self.clock.observe(msg.clock)
+            self.add_request(PendingRequest(
+                msg, properties.reply_to, properties.correlation_id, codec, headers.get("trace_id")
+            ))
+        elif properties.type == RELEASE_EVENT:
+            if self.release_request(msg.resource or DEFAULT_RESOURCE, msg.request_id):
+                self.log.debug("RELEASE de %s aplicado para %s", properties.app_id, msg.request_id)
 
-    def enter_critical_section(self, request):
+    def restore(self, wal):
+        """Reaplica o snapshot e os segmentos do log local"""
+        started = time.monotonic()
+        count = 0
+        # Nada é concedido durante o replay; as filas são reavaliadas no final
+        leader, self.is_leader = self.is_leader, False
         try:
-            print(f"[{self.SYNC_ID}] Entrando na seção crítica para {request['client_id']} ({request['request_id']})")
-            time.sleep(random.uniform(0.2, 1.0))  # Simula processamento
-
-            release_msg = {
-                "client_id": request["client_id"],
-                "timestamp": request["timestamp"],
-                "request_id": request["request_id"],
-                "primitiva": "RELEASE"
-            }
-            
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=self.rabbitmq_queue,
-                body=json.dumps(release_msg).encode(),
-                properties=pika.BasicProperties(delivery_mode=2)
+            for record in wal.replay():
+                count += 1
+                if record[0] == ACQUIRE_RECORD:
+                    self.clock.observe(record[1].message.clock)
+                    self.add_request(record[1])
+                elif record[0] == GRANT_RECORD:
+                    if leader:
+                        self.restore_grant(record[1], record[2])
+                elif record[0] == RELEASE_RECORD:
+                    self.release_request(record[1], record[2])
+        finally:
+            self.is_leader = leader
+        with self.grant_lock:
+            for resource in self.grant_queues:
+                self.schedule(resource)
+        pending = self.pending_count()
+        elapsed = (time.monotonic() - started) * 1000
+        self.log.info("Log restaurado: %d registros, %d pedidos pendentes em %.1fms", count, pending, elapsed)
+
+    def restore_grant(self, resource, request_id):
+        """Refaz uma concessão com lease registrada no log, com um lease novo.
+
+        Concessões sem lease não são refeitas: a seção crítica rodava neste
+        processo e se perdeu com ele, então o pedido volta a esperar.
+        """
+        with self.grant_lock:
+            queue = self.grant_queues.get(resource)
+            request = queue.get(request_id) if queue is not None else None
+            if request is None:
+                return
+            msg = request.message
+            if not msg.lease_ms or queue.mark_granted(request_id) is None:
+                return
+            request.granted_at = time.monotonic()
+            self.holders.setdefault(resource, {})[request_id] = msg.mode
+            self.leases.grant(resource, request_id, msg.lease_ms / 1000)
+            self.lease_cond.notify()
+
+    def pending_requests(self):
+        with self.grant_lock:
+            return [request for queue in self.grant_queues.values() for request in queue]
+
+    def pending_count(self):
+        # Sem montar a lista de pedidos: o gauge é lido a cada scrape
+        with self.grant_lock:
+            return sum(len(queue) for queue in self.grant_queues.values())
+
+    def publish_event(self, event_type, body=b'', content_type=None, reply_to=None, correlation_id=None,
+                      trace_id=None):
+        """Publica um evento de replicação no exchange fanout"""
+        headers = {"leader": self.is_leader, "term": self.lease.term if self.lease else 0}
+        if trace_id:
+            headers["trace_id"] = trace_id
+        self.publisher.publish(
+            exchange=self.events_exchange,
+            routing_key='',
+            body=body,
+            properties=pika.BasicProperties(
+                type=event_type,
+                app_id=self.SYNC_ID,
+                content_type=content_type,
+                reply_to=reply_to,
+                correlation_id=correlation_id,
+                headers=headers
             )
+        )
+
+    def replicate_pending(self):
+        """Reenvia todos os pedidos pendentes, para uma réplica que acabou de entrar"""
+        pending = self.pending_requests()
+        for request in pending:
+            self.publish_event(
+                ACQUIRE_EVENT, request.codec.encode(request.message), request.codec.content_type,
+                request.reply_to, request.correlation_id, request.trace_id
+            )
+        # Depois dos ACQUIREs: a réplica descarta o que restaurou do seu log e
+        # o cluster já concluiu enquanto ela estava fora
+        request_ids = [request.message.request_id for request in pending]
+        self.publish_event(SYNC_STATE, json.dumps(request_ids).encode(), "application/json")
+
+    def reconcile(self, request_ids):
+        """Remove os pedidos locais que não estão mais pendentes no líder"""
+        request_ids = set(request_ids)
+        with self.grant_lock:
+            stale = [
+                (resource, request.message.request_id)
+                for resource, queue in self.grant_queues.items()
+                for request in queue
+                if request.message.request_id not in request_ids
+            ]
+            for resource, request_id in stale:
+                self.release_locked(resource, request_id)
+        if stale:
+            self.log.info("%d pedidos restaurados já concluídos no líder foram descartados", len(stale))
+
+    def on_heartbeat_timer(self):
+        """Executa na thread da conexão: envia o heartbeat e reavalia o líder"""
+        try:
+            self.publish_event(HEARTBEAT)
+            if self.lease.update():
+                if self.lease.is_leader and not self.is_leader:
+                    self.become_leader()
+                elif not self.lease.is_leader and self.is_leader:
+                    self.step_down()
+        finally:
+            self.connection.call_later(self.heartbeat_interval, self.on_heartbeat_timer)
+
+    def become_leader(self):
+        self.log.info("Assumindo a liderança (termo %d)", self.lease.term)
+        with self.grant_lock:
+            self.is_leader = True
+            # Concessões do líder anterior sem RELEASE são refeitas por este nó
+            self.holders.clear()
+            for resource, queue in self.grant_queues.items():
+                queue.requeue_granted()
+                self.schedule(resource)
+        self.consume_requests()
+
+    def lose_leadership(self):
+        """Conexão perdida: para de conceder e descarta o estado das concessões"""
+        with self.grant_lock:
+            self.is_leader = False
+            self.holders.clear()
+            self.leases = LeaseTable()
+        self.lease.reset()
 
-            self.state['release_list'].append(request["request_id"])
-            print(f"[{self.SYNC_ID}] RELEASE publicado para {request['request_id']}")
-
-            # Envia COMMITTED de volta ao cliente
-            if "reply_to" in request and "correlation_id" in request:
-                committed = {"status": "COMMITTED", "request_id": request["request_id"]}
-                self.channel.basic_publish(
-                    exchange='',
-                    routing_key=request["reply_to"],
-                    properties=pika.BasicProperties(
-                        correlation_id=request["correlation_id"],
-                        content_type='application/json',
-                        delivery_mode=2
-                    ),
-                    body=json.dumps(committed).encode()
+    def step_down(self):
+        self.log.info("Deixando a liderança para %s", self.lease.leader)
+        with self.grant_lock:
+            self.is_leader = False
+            self.leases = LeaseTable()
+        if self.consumer_tag is not None:
+            self.acker.flush()
+            self.channel.basic_cancel(self.consumer_tag)
+            self.consumer_tag = None
+
+    def admission(self, request):
+        """Retorna 0 se o pedido pode entrar na fila ou, se não, o tempo sugerido para tentar de novo"""
+        if not (self.max_pending or self.max_wait):
+            return 0
+        msg = request.message
+        with self.grant_lock:
+            queue = self.grant_queues.get(msg.resource or DEFAULT_RESOURCE)
+            if queue is None or msg.request_id in queue:
+                return 0  # Fila vazia ou redelivery de um pedido já aceito
+            depth = len(queue)
+            estimated_wait = depth * self.hold_estimate
+        if (self.max_pending and depth >= self.max_pending) or (self.max_wait and estimated_wait > self.max_wait):
+            return max(estimated_wait, self.retry_after_min)
+        return 0
+
+    def add_request(self, request):
+        resource = request.message.resource or DEFAULT_RESOURCE
+        # Codifica o registro antes de mexer na fila: um pedido que não cabe
+        # no log levanta ValueError (e vai para a dead-letter) sem deixar rastro
+        record = encode_acquire(request) if self.wal is not None else None
+        with self.grant_lock:
+            queue = self.grant_queues.get(resource)
+            if queue is None:
+                queue = self.grant_queues[resource] = GrantQueue(
+                    self.recent, weights=self.client_weights, shared_limit=self.shared_limit
+                )
+            added = queue.add(request.message.request_id, request)
+            if added and record is not None:
+                self.wal.append_acquire(request, record)
+            self.schedule(resource)
+            self.drop_idle(resource)
+        return added
+
+    def drop_idle(self, resource):
+        """Descarta a fila do recurso se não há pedidos nela (chamar com grant_lock)"""
+        queue = self.grant_queues.get(resource)
+        if queue is not None and not queue and not self.holders.get(resource):
+            del self.grant_queues[resource]
+
+    def schedule(self, resource):
+        """Concede o recurso ao próximo lote compatível da fila (chamar com grant_lock)"""
+        if not self.is_leader:
+            return
+        held = self.holders.get(resource)
+        held_mode = next(iter(held.values())) if held else None
+        batch = self.grant_queues[resource].grant_batch(held_mode)
+        if not batch:
+            return
+        holders = self.holders.setdefault(resource, {})
+        granted_at = time.monotonic()
+        executed = []
+        for request in batch:
+            msg = request.message
+            holders[msg.request_id] = msg.mode
+            request.granted_at = granted_at
+            self.grant_wait.observe(granted_at - request.received_at)
+            if self.wal is not None:
+                self.wal.append_grant(resource, msg.request_id)
+            self.leases.grant(resource, msg.request_id, msg.lease_ms / 1000 if msg.lease_ms else self.grant_lease)
+            if msg.lease_ms:
+                # O cliente mantém a seção crítica até o RELEASE ou o fim do lease
+                self.send_committed(request, msg.lease_ms)
+                self.log.debug(
+                    "%s concedido a %s por %dms (%s)", resource, msg.sender, msg.lease_ms, msg.mode,
+                    extra={"fields": {"request_id": msg.request_id, "trace_id": request.trace_id}}
                 )
-                print(f"[{self.SYNC_ID}] COMMITTED enviado a {request['client_id']}")
-                
-        except pika.exceptions.AMQPError as e:
-            print(f"[{self.SYNC_ID}] Erro ao publicar mensagem: {str(e)}")
-            self.reconnect()
+            else:
+                executed.append(request)
+        self.lease_cond.notify()
+        if executed:
+            # Um lote compartilhado passa pela seção crítica de uma só vez
+            self.workers.submit(self.run_grant, resource, executed)
+
+    def renew_lease(self, msg):
+        resource = msg.resource or DEFAULT_RESOURCE
+        with self.grant_lock:
+            return self.leases.renew(resource, msg.request_id, (msg.lease_ms or 0) / 1000 or self.grant_lease)
+
+    def run_lease_reaper(self):
+        """Dorme até o próximo vencimento de lease e libera os recursos expirados"""
+        with self.lease_cond:
+            while True:
+                deadline = self.leases.next_deadline()
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                self.lease_cond.wait(timeout)
+                for resource, request_id in self.leases.expire():
+                    self.log.warning("Lease de %s em %s expirou; liberando", request_id, resource)
+                    self.expired_leases.inc()
+                    self.release_locked(resource, request_id)
+
+    def run_grant(self, resource, batch):
+        try:
+            self.enter_critical_section(resource, batch)
+        except Exception as e:
+            self.log.error("Erro no processamento: %s", e)
+        finally:
+            # Garante que um pedido com falha não bloqueie a fila
+            with self.grant_lock:
+                for request in batch:
+                    self.release_locked(resource, request.message.request_id)
+
+    def release_request(self, resource, request_id):
+        with self.grant_lock:
+            return self.release_locked(resource, request_id)
+
+    def release_locked(self, resource, request_id):
+        queue = self.grant_queues.get(resource)
+        released = queue.release(request_id) if queue is not None else None
+        if released is not None:
+            if released.granted_at is not None:
+                held = time.monotonic() - released.granted_at
+                self.hold_time.observe(held)
+                self.hold_estimate += 0.2 * (held - self.hold_estimate)
+            if self.wal is not None:
+                self.wal.append_release(resource, request_id)
+            # Só as outras réplicas precisam ser avisadas
+            if self.is_leader and self.events_exchange:
+                msg = released.message
+                release_msg = Message(RELEASE, msg.sender, msg.timestamp, msg.request_id, msg.resource)
+                self.publish_event(RELEASE_EVENT, released.codec.encode(release_msg), released.codec.content_type)
+        held = self.holders.get(resource)
+        if held is not None and held.pop(request_id, None) is not None:
+            self.leases.drop(resource, request_id)
+            if not held:
+                del self.holders[resource]
+        if queue is not None:
+            self.schedule(resource)
+            self.drop_idle(resource)
+        return released is not None
+
+    def enter_critical_section(self, resource, batch):
+        """Executa a seção crítica uma vez para o lote e responde a todos os pedidos dele"""
+        for request in batch:
+            msg = request.message
+            self.log.debug(
+                "Entrando na seção crítica de %s para %s (%s)", resource, msg.sender, msg.mode,
+                extra={"fields": {"request_id": msg.request_id, "trace_id": request.trace_id}}
+            )
+        time.sleep(random.uniform(0.2, 1.0))  # Simula processamento
+
+        # O RELEASE local é aplicado direto na memória, sem passar pela r_queue
+        with self.grant_lock:
+            released = [request for request in batch if self.release_locked(resource, request.message.request_id)]
+        if len(released) < len(batch):
+            self.log.info("%d concessões de %s já haviam expirado", len(batch) - len(released), resource)
+        for request in released:
+            self.send_committed(request)
+        self.log.debug("RELEASE aplicado para %d pedidos de %s", len(released), resource)
+
+    def send_committed(self, request, lease_ms=0):
+        """Envia COMMITTED de volta ao cliente, no mesmo codec do pedido"""
+        msg = request.message
+        self.reply(request, Message(
+            COMMITTED, self.SYNC_ID, now_us(), msg.request_id, msg.resource, lease_ms, self.clock.tick()
+        ))
+
+    def send_rejected(self, request, retry_after):
+        """Recusa o pedido na hora, sugerindo quando tentar de novo"""
+        msg = request.message
+        self.reply(request, Message(
+            REJECTED, self.SYNC_ID, now_us(), msg.request_id, msg.resource,
+            clock=self.clock.tick(), retry_after_ms=int(retry_after * 1000)
+        ))
+
+    def reply(self, request, response):
+        """Publica a resposta na fila reply_to do cliente, no mesmo codec do pedido"""
+        if not (request.reply_to and request.correlation_id):
+            return
+        self.publisher.publish(
+            exchange='',
+            routing_key=request.reply_to,
+            properties=pika.BasicProperties(
+                correlation_id=request.correlation_id,
+                content_type=request.codec.content_type,
+                delivery_mode=2,
+                headers={"trace_id": request.trace_id} if request.trace_id else None
+            ),
+            body=request.codec.encode(response)
+        )
+        self.log.debug(
+            "%s enviado a %s", response.type, request.message.sender,
+            extra={"fields": {"request_id": response.request_id, "trace_id": request.trace_id}}
+        )
 
 if __name__ == "__main__":
     try:
-        sync = ClusterSync()
-        sync.start_consuming()
+        # SYNC_MODE=async usa a variante asyncio (aio-pika) do coordenador
+        if os.getenv("SYNC_MODE", "thread") == "async":
+            import asyncio
+            from cluster_sync_async import AsyncClusterSync
+            asyncio.run(AsyncClusterSync().run())
+        else:
+            sync = ClusterSync()
+            sync.run()
     except KeyboardInterrupt:
         print("\nEncerrando processo...")
     except Exception as e:
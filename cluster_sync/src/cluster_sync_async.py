@@ -0,0 +1,341 @@
+import asyncio
+import random
+import os
+import time
+
+import aio_pika
+
+from grant_queue import GrantQueue, PendingRequest, RecentIds
+from leases import LeaseTable
+from shared.log import get_logger
+from shared.protocol import ACQUIRE, RELEASE, RENEW, COMMITTED, REJECTED, DEFAULT_RESOURCE, Message, get_codec, now_us
+
+# Recursos do ClusterSync que esta variante não implementa; com um deles
+# configurado, a partida falha em vez de ignorá-lo em silêncio. Aqui cada
+# mensagem é confirmada na hora (sem ACK_BATCH_SIZE/ACK_INTERVAL_MS)
+UNSUPPORTED_SETTINGS = (
+    "SYNC_EVENTS_EXCHANGE", "WAL_DIR", "SHARD_EXCHANGE",
+    "METRICS_PORT", "ACK_BATCH_SIZE", "ACK_INTERVAL_MS",
+)
+
+
+class AsyncClusterSync:
+    """Variante asyncio do ClusterSync: mesmo protocolo na 'r_queue',
+    mas todos os pedidos pendentes são tratados em um único event loop."""
+
+    def __init__(self):
+        self.SYNC_ID = os.getenv("SYNC_ID", "sync_1")
+        self.log = get_logger(self.SYNC_ID)
+        self.rabbitmq_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
+        self.rabbitmq_user = os.getenv("RABBITMQ_USER", "Nicole")
+        self.rabbitmq_pass = os.getenv("RABBITMQ_PASS", "nicole123")
+        self.rabbitmq_queue = os.getenv("RABBITMQ_QUEUE", "r_queue")
+        # Mesmo desvio do ClusterSync para mensagens que nunca serão processadas
+        self.dead_letter_queue = os.getenv("DEAD_LETTER_QUEUE", f"{self.rabbitmq_queue}.dead")
+        self.prefetch_count = int(os.getenv("PREFETCH_COUNT", "100"))
+        unsupported = [name for name in UNSUPPORTED_SETTINGS if os.getenv(name)]
+        if unsupported:
+            raise ValueError(f"SYNC_MODE=async não suporta {', '.join(unsupported)}")
+
+        self.connection = None
+        self.channel = None
+        # Uma fila de concessão por recurso; cada concessão roda como uma task
+        self.grant_queues = {}   # recurso -> GrantQueue, descartada quando fica vazia
+        self.recent = RecentIds()  # deduplicação de request_ids, comum a todas as filas
+        self.holders = {}        # recurso -> {request_id: modo} das concessões ativas
+        self.tasks = set()       # referências às tasks em execução (evita coleta pelo GC)
+        # Mesmas regras de concessão do ClusterSync: limite de leitores à frente
+        # de um exclusivo, pesos por cliente, leases com expiração e controle de admissão
+        self.client_weights = {}
+        for item in filter(None, os.getenv("CLIENT_WEIGHTS", "").split(",")):
+            client_id, weight = item.split(":")
+            self.client_weights[client_id.strip()] = float(weight)
+        self.shared_limit = int(os.getenv("SHARED_LIMIT", "64"))
+        self.leases = LeaseTable()
+        self.grant_lease = int(os.getenv("GRANT_LEASE_MS", "30000")) / 1000
+        self.reaper = None       # timer do event loop para o próximo vencimento
+        self.max_pending = int(os.getenv("MAX_PENDING", "0"))
+        self.max_wait = int(os.getenv("MAX_WAIT_MS", "0")) / 1000
+        self.retry_after_min = int(os.getenv("RETRY_AFTER_MS", "100")) / 1000
+        self.hold_estimate = 0.0  # média móvel do tempo de posse, em segundos
+
+    async def connect(self):
+        max_retries = 5
+        retry_delay = 3
+
+        for attempt in range(max_retries):
+            try:
+                # connect_robust reconecta e redeclara a topologia sozinho
+                self.connection = await aio_pika.connect_robust(
+                    host=self.rabbitmq_host,
+                    login=self.rabbitmq_user,
+                    password=self.rabbitmq_pass,
+                    heartbeat=600
+                )
+                self.channel = await self.connection.channel()
+                await self.channel.set_qos(prefetch_count=self.prefetch_count)
+
+                self.queue = await self.channel.declare_queue(
+                    self.rabbitmq_queue,
+                    durable=True,
+                    arguments={
+                        'x-message-ttl': 60000,
+                        'x-dead-letter-exchange': ''
+                    }
+                )
+                await self.channel.declare_queue(self.dead_letter_queue, durable=True)
+                return True
+
+            except Exception as e:
+                self.log.warning("Tentativa %d/%d - Erro ao conectar: %s", attempt + 1, max_retries, e)
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(retry_delay)
+
+        raise Exception("Não foi possível conectar ao RabbitMQ após várias tentativas")
+
+    async def on_message(self, message):
+        if not message.body:
+            await self.dead_letter(message, "corpo vazio")
+            return
+
+        codec = get_codec(message.content_type)
+        try:
+            msg = codec.decode(message.body)
+        except ValueError as e:
+            # Falha determinística: reentregar só repetiria o erro
+            self.log.warning("Mensagem inválida: %s", e)
+            await self.dead_letter(message, str(e))
+            return
+
+        trace_id = (message.headers or {}).get("trace_id")
+        try:
+            if msg.type == ACQUIRE:
+                request = PendingRequest(msg, message.reply_to, message.correlation_id, codec, trace_id)
+                retry_after = self.admission(request)
+                if retry_after:
+                    await self.reply(request, Message(
+                        REJECTED, self.SYNC_ID, now_us(), msg.request_id, msg.resource,
+                        retry_after_ms=int(retry_after * 1000)
+                    ))
+                else:
+                    self.add_request(request)
+                self.log.debug(
+                    "ACQUIRE recebido de %s (%s)", msg.sender, msg.resource or DEFAULT_RESOURCE,
+                    extra={"fields": {"request_id": msg.request_id, "trace_id": trace_id}}
+                )
+
+            elif msg.type == RELEASE:
+                if self.release_request(msg.resource or DEFAULT_RESOURCE, msg.request_id):
+                    self.log.debug(
+                        "RELEASE registrado de %s", msg.sender,
+                        extra={"fields": {"request_id": msg.request_id, "trace_id": trace_id}}
+                    )
+
+            elif msg.type == RENEW:
+                resource = msg.resource or DEFAULT_RESOURCE
+                if self.leases.renew(resource, msg.request_id, msg.lease_ms / 1000 or self.grant_lease):
+                    self.arm_reaper()
+                else:
+                    self.log.info(
+                        "RENEW ignorado: %s não detém %s", msg.request_id, resource,
+                        extra={"fields": {"request_id": msg.request_id, "trace_id": trace_id}}
+                    )
+
+            await message.ack()
+
+        except ValueError as e:
+            self.log.warning("Mensagem inválida: %s", e)
+            await self.dead_letter(message, str(e))
+        except Exception as e:
+            self.log.error("Erro ao processar mensagem: %s", e)
+            if message.redelivered:
+                # Já falhou numa entrega anterior: não volta mais para a fila
+                await self.dead_letter(message, str(e))
+            else:
+                await message.nack()
+
+    async def dead_letter(self, message, reason):
+        """Tira a entrega da r_queue, guardando uma cópia na fila de mensagens mortas"""
+        headers = dict(message.headers or {})
+        headers["x-death-reason"] = reason
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(
+                body=message.body,
+                content_type=message.content_type,
+                reply_to=message.reply_to,
+                correlation_id=message.correlation_id,
+                headers=headers,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+            ),
+            routing_key=self.dead_letter_queue
+        )
+        # Sem nack: o DLX da r_queue ('' sem routing key) a devolveria à própria fila
+        await message.ack()
+
+    def admission(self, request):
+        """Retorna 0 se o pedido pode entrar na fila ou, se não, o tempo sugerido para tentar de novo"""
+        if not (self.max_pending or self.max_wait):
+            return 0
+        msg = request.message
+        queue = self.grant_queues.get(msg.resource or DEFAULT_RESOURCE)
+        if queue is None or msg.request_id in queue:
+            return 0  # Fila vazia ou redelivery de um pedido já aceito
+        depth = len(queue)
+        estimated_wait = depth * self.hold_estimate
+        if (self.max_pending and depth >= self.max_pending) or (self.max_wait and estimated_wait > self.max_wait):
+            return max(estimated_wait, self.retry_after_min)
+        return 0
+
+    def add_request(self, request):
+        resource = request.message.resource or DEFAULT_RESOURCE
+        queue = self.grant_queues.get(resource)
+        if queue is None:
+            queue = self.grant_queues[resource] = GrantQueue(
+                self.recent, weights=self.client_weights, shared_limit=self.shared_limit
+            )
+        queue.add(request.message.request_id, request)
+        self.schedule(resource)
+        self.drop_idle(resource)
+
+    def drop_idle(self, resource):
+        """Descarta a fila do recurso se não há pedidos nela"""
+        queue = self.grant_queues.get(resource)
+        if queue is not None and not queue and not self.holders.get(resource):
+            del self.grant_queues[resource]
+
+    def schedule(self, resource):
+        """Concede o recurso ao próximo lote compatível da fila"""
+        held = self.holders.get(resource)
+        held_mode = next(iter(held.values())) if held else None
+        batch = self.grant_queues[resource].grant_batch(held_mode)
+        if not batch:
+            return
+        holders = self.holders.setdefault(resource, {})
+        granted_at = time.monotonic()
+        executed = []
+        for request in batch:
+            msg = request.message
+            holders[msg.request_id] = msg.mode
+            request.granted_at = granted_at
+            self.leases.grant(resource, msg.request_id, msg.lease_ms / 1000 if msg.lease_ms else self.grant_lease)
+            if msg.lease_ms:
+                # O cliente mantém a seção crítica até o RELEASE ou o fim do lease
+                self.spawn(self.send_committed(request, msg.lease_ms))
+                self.log.debug(
+                    "%s concedido a %s por %dms (%s)", resource, msg.sender, msg.lease_ms, msg.mode,
+                    extra={"fields": {"request_id": msg.request_id, "trace_id": request.trace_id}}
+                )
+            else:
+                executed.append(request)
+        self.arm_reaper()
+        if executed:
+            # Um lote compartilhado passa pela seção crítica de uma só vez
+            self.spawn(self.run_grant(resource, executed))
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def arm_reaper(self):
+        """Agenda no event loop a expiração do próximo lease a vencer"""
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+        deadline = self.leases.next_deadline()
+        if deadline is not None:
+            self.reaper = asyncio.get_running_loop().call_later(
+                max(deadline - time.monotonic(), 0), self.expire_leases
+            )
+
+    def expire_leases(self):
+        self.reaper = None
+        for resource, request_id in self.leases.expire():
+            self.log.warning("Lease de %s em %s expirou; liberando", request_id, resource)
+            self.release_request(resource, request_id)
+        self.arm_reaper()
+
+    async def run_grant(self, resource, batch):
+        try:
+            await self.enter_critical_section(resource, batch)
+        except Exception as e:
+            self.log.error("Erro no processamento: %s", e)
+        finally:
+            # Garante que um pedido com falha não bloqueie a fila
+            for request in batch:
+                self.release_request(resource, request.message.request_id)
+
+    def release_request(self, resource, request_id):
+        queue = self.grant_queues.get(resource)
+        released = queue.release(request_id) if queue is not None else None
+        if released is not None and released.granted_at is not None:
+            self.hold_estimate += 0.2 * (time.monotonic() - released.granted_at - self.hold_estimate)
+        held = self.holders.get(resource)
+        if held is not None and held.pop(request_id, None) is not None:
+            self.leases.drop(resource, request_id)
+            if not held:
+                del self.holders[resource]
+        if queue is not None:
+            self.schedule(resource)
+            self.drop_idle(resource)
+        return released is not None
+
+    async def enter_critical_section(self, resource, batch):
+        """Executa a seção crítica uma vez para o lote e responde a todos os pedidos dele"""
+        for request in batch:
+            msg = request.message
+            self.log.debug(
+                "Entrando na seção crítica de %s para %s (%s)", resource, msg.sender, msg.mode,
+                extra={"fields": {"request_id": msg.request_id, "trace_id": request.trace_id}}
+            )
+        await asyncio.sleep(random.uniform(0.2, 1.0))  # Simula processamento
+
+        # O RELEASE local é aplicado direto na memória, sem passar pela r_queue
+        released = [request for request in batch if self.release_request(resource, request.message.request_id)]
+        if len(released) < len(batch):
+            self.log.info("%d concessões de %s já haviam expirado", len(batch) - len(released), resource)
+        for request in released:
+            await self.send_committed(request)
+        self.log.debug("RELEASE aplicado para %d pedidos de %s", len(released), resource)
+
+    async def send_committed(self, request, lease_ms=0):
+        """Envia COMMITTED de volta ao cliente, no mesmo codec do pedido"""
+        msg = request.message
+        await self.reply(request, Message(COMMITTED, self.SYNC_ID, now_us(), msg.request_id, msg.resource, lease_ms))
+
+    async def reply(self, request, response):
+        """Publica a resposta na fila reply_to do cliente, no mesmo codec do pedido"""
+        if not (request.reply_to and request.correlation_id):
+            return
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(
+                body=request.codec.encode(response),
+                correlation_id=request.correlation_id,
+                content_type=request.codec.content_type,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                headers={"trace_id": request.trace_id} if request.trace_id else None
+            ),
+            routing_key=request.reply_to
+        )
+        self.log.debug(
+            "%s enviado a %s", response.type, request.message.sender,
+            extra={"fields": {"request_id": response.request_id, "trace_id": request.trace_id}}
+        )
+
+    async def run(self):
+        await self.connect()
+        await self.queue.consume(self.on_message)
+        self.log.info("Iniciado (asyncio) e ouvindo a fila '%s'", self.rabbitmq_queue)
+        try:
+            await asyncio.Future()
+        finally:
+            await self.connection.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(AsyncClusterSync().run())
+    except KeyboardInterrupt:
+        print("\nEncerrando processo...")
+    except Exception as e:
+        print(f"Erro fatal: {str(e)}")
@@ -0,0 +1,209 @@
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from operator import itemgetter
+
+from shared.protocol import EXCLUSIVE, SHARED
+
+
+class PendingRequest:
+    """Pedido ACQUIRE aguardando a seção crítica, com os dados para responder ao cliente"""
+
+    __slots__ = ("message", "reply_to", "correlation_id", "codec", "trace_id", "received_at", "granted_at")
+
+    def __init__(self, message, reply_to, correlation_id, codec, trace_id=None):
+        self.message = message
+        self.reply_to = reply_to
+        self.correlation_id = correlation_id
+        self.codec = codec
+        self.trace_id = trace_id            # vem no header "trace_id" do ACQUIRE
+        self.received_at = time.monotonic()
+        self.granted_at = None
+
+
+class RecentIds:
+    """request_ids concluídos recentemente, para descartar ACQUIRE/RELEASE duplicados.
+
+    Um só conjunto, limitado a `limit` ids, compartilhado por todas as filas
+    de concessão: a memória não cresce com a quantidade de recursos já vistos.
+    """
+
+    def __init__(self, limit=10000):
+        self._ids = OrderedDict()
+        self._limit = limit
+
+    def __contains__(self, request_id):
+        return request_id in self._ids
+
+    def add(self, request_id):
+        self._ids[request_id] = None
+        if len(self._ids) > self._limit:
+            self._ids.popitem(last=False)
+
+
+class GrantQueue:
+    """Fila de concessão em heap, ordenada por (prioridade, rodada, relógio, cliente).
+
+    - prioridade: classes maiores passam na frente (message.priority);
+    - rodada: justiça entre clientes. O n-ésimo pedido pendente de um cliente
+      cai n rodadas à frente da rodada atual (n / peso, com `weights`), então
+      um cliente com muitos pedidos não deixa os outros esperando;
+    - relógio: relógio de Lamport do pedido, com o client_id como desempate.
+
+    grant_batch() retira do heap os pedidos concedidos: um exclusivo sozinho
+    ou um lote de compartilhados consecutivos. Enquanto um exclusivo espera,
+    no máximo `shared_limit` compartilhados são concedidos antes dele, para
+    que um fluxo contínuo de leitores não o deixe esperando para sempre.
+
+    Liberações fora de ordem só removem o pedido de _pending; a entrada no
+    heap é descartada quando chega ao topo (remoção preguiçosa). Inserir e
+    liberar custam O(log n). A exceção é o caso do limite de leitores: quando
+    o topo é um compartilhado e o exclusivo precisa passar na frente,
+    grant_batch() procura o primeiro exclusivo percorrendo o heap, em O(n).
+    """
+
+    def __init__(self, recent=None, weights=None, shared_limit=64):
+        self._heap = []          # (-prioridade, rodada, relógio, cliente, seq, request_id)
+        self._pending = {}       # request_id -> (entrada no heap, pedido), aguardando ou concedido
+        self._granted = set()    # request_ids já concedidos e ainda não liberados
+        self._seq = itertools.count()
+        self._weights = weights or {}   # client_id -> peso (pedidos por rodada)
+        self._round = 0.0               # rodada do último pedido concluído
+        self._last_round = {}           # client_id -> rodada do seu último pedido
+        self._shared_limit = shared_limit
+        self._exclusive_waiting = 0     # exclusivos ainda não concedidos
+        self._bypassed = 0              # compartilhados concedidos com um exclusivo esperando
+        # Últimos request_ids concluídos (RecentIds, em geral compartilhado entre as filas)
+        self._recent = recent if recent is not None else RecentIds()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, request_id):
+        return request_id in self._pending
+
+    def get(self, request_id):
+        """Pedido pendente (concedido ou não) com esse request_id, ou None"""
+        pending = self._pending.get(request_id)
+        return pending[1] if pending is not None else None
+
+    def __iter__(self):
+        """Pedidos pendentes (concedidos ou não) na ordem de concessão"""
+        for entry, request in sorted(self._pending.values(), key=itemgetter(0)):
+            yield request
+
+    def add(self, request_id, request):
+        """Enfileira um pedido; ignora request_ids repetidos (redelivery)"""
+        if request_id in self._pending or request_id in self._recent:
+            return False
+        msg = request.message
+        sender = msg.sender or ""
+        last = self._last_round.get(sender)
+        if last is None:
+            start = self._round
+        else:
+            start = max(self._round, last + 1 / self._weights.get(sender, 1))
+        # Monta a entrada antes de alterar qualquer estado. Os campos
+        # comparados no heap chegam com tipo validado pelo codec
+        # (Message.from_dict), então o heappush não falha no meio
+        entry = (-(msg.priority or 0), start, msg.clock or 0, sender, next(self._seq), request_id)
+        heapq.heappush(self._heap, entry)
+        self._last_round[sender] = start
+        self._pending[request_id] = (entry, request)
+        if msg.mode != SHARED:
+            self._exclusive_waiting += 1
+        return True
+
+    def release(self, request_id):
+        """Remove o pedido da fila; retorna o pedido removido ou None se ele não estava pendente"""
+        pending = self._pending.pop(request_id, None)
+        if pending is None:
+            return None
+        entry, request = pending
+        if request_id in self._granted:
+            self._granted.discard(request_id)
+        elif request.message.mode != SHARED:
+            self._exclusive_waiting -= 1
+            if not self._exclusive_waiting:
+                # Nenhum exclusivo esperando: a contagem de leitores recomeça
+                self._bypassed = 0
+        self._recent.add(request_id)
+        self._round = max(self._round, entry[1])
+        # Cliente sem pedidos à frente da rodada atual não precisa mais de estado
+        sender = entry[3]
+        last = self._last_round.get(sender)
+        if last is not None and last + 1 / self._weights.get(sender, 1) <= self._round:
+            del self._last_round[sender]
+        self._compact()
+        return request
+
+    def grant_batch(self, held_mode=None):
+        """Marca como concedido o próximo lote compatível e retorna seus pedidos.
+
+        held_mode é o modo das concessões ativas no recurso (None se livre).
+        """
+        if held_mode == EXCLUSIVE:
+            return []
+        batch = []
+        self._compact()
+        while self._heap:
+            request = self._pending[self._heap[0][-1]][1]
+            if request.message.mode != SHARED:
+                if held_mode is None and not batch:
+                    self._grant(heapq.heappop(self._heap), request)
+                    batch.append(request)
+                break
+            if self._exclusive_waiting and self._bypassed >= self._shared_limit:
+                break
+            self._grant(heapq.heappop(self._heap), request)
+            batch.append(request)
+            self._compact()
+        if not batch and held_mode is None and self._exclusive_waiting:
+            # Limite de leitores atingido: o primeiro exclusivo passa na frente
+            entry = min(
+                entry for entry in self._heap
+                if self._is_waiting(entry) and self._pending[entry[-1]][1].message.mode != SHARED
+            )
+            request = self._pending[entry[-1]][1]
+            self._grant(entry, request)  # A entrada sai do heap quando chegar ao topo
+            batch.append(request)
+        return batch
+
+    def _grant(self, entry, request):
+        self._granted.add(entry[-1])
+        if request.message.mode == SHARED:
+            if self._exclusive_waiting:
+                self._bypassed += 1
+        else:
+            self._exclusive_waiting -= 1
+            self._bypassed = 0
+
+    def mark_granted(self, request_id):
+        """Marca um pedido pendente como concedido fora de grant_batch (replay do log)"""
+        pending = self._pending.get(request_id)
+        if pending is None or request_id in self._granted:
+            return None
+        entry, request = pending
+        self._grant(entry, request)  # A entrada sai do heap quando chegar ao topo
+        return request
+
+    def requeue_granted(self):
+        """Devolve à espera os pedidos concedidos (novo líder refaz as concessões)"""
+        for request_id in self._granted:
+            entry, request = self._pending[request_id]
+            heapq.heappush(self._heap, entry)
+            if request.message.mode != SHARED:
+                self._exclusive_waiting += 1
+        self._granted.clear()
+        self._bypassed = 0
+
+    def _is_waiting(self, entry):
+        pending = self._pending.get(entry[-1])
+        return pending is not None and pending[0] is entry and entry[-1] not in self._granted
+
+    def _compact(self):
+        # Descarta do topo do heap os pedidos já liberados ou concedidos
+        heap = self._heap
+        while heap and not self._is_waiting(heap[0]):
+            heapq.heappop(heap)
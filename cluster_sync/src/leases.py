@@ -0,0 +1,55 @@
+import heapq
+import time
+
+
+class LeaseTable:
+    """Leases das concessões ativas, um por pedido concedido, com expiração por heap.
+
+    Um recurso exclusivo tem um lease; um lote compartilhado tem um por
+    leitor. Renovar só empurra uma nova entrada no heap; entradas antigas são
+    descartadas quando chegam ao topo (remoção preguiçosa). Assim conceder,
+    renovar e expirar custam O(log n).
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []     # (expira_em, recurso, request_id)
+        self._active = {}   # (recurso, request_id) -> expira_em
+
+    def __len__(self):
+        return len(self._active)
+
+    def grant(self, resource, request_id, duration):
+        expires_at = self.clock() + duration
+        self._active[resource, request_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, resource, request_id))
+
+    def renew(self, resource, request_id, duration):
+        """Estende o lease; retorna False se o pedido não detém mais o recurso"""
+        if (resource, request_id) not in self._active:
+            return False
+        self.grant(resource, request_id, duration)
+        return True
+
+    def drop(self, resource, request_id):
+        self._active.pop((resource, request_id), None)
+
+    def next_deadline(self):
+        """Instante da próxima expiração possível (ou None se não há leases)"""
+        while self._heap:
+            expires_at, resource, request_id = self._heap[0]
+            if self._active.get((resource, request_id)) == expires_at:
+                return expires_at
+            heapq.heappop(self._heap)  # Entrada renovada ou já liberada
+        return None
+
+    def expire(self):
+        """Remove e retorna os (recurso, request_id) cujo lease venceu"""
+        now = self.clock()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, resource, request_id = heapq.heappop(self._heap)
+            if self._active.get((resource, request_id)) == expires_at:
+                del self._active[resource, request_id]
+                expired.append((resource, request_id))
+        return expired
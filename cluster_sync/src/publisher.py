@@ -0,0 +1,138 @@
+import time
+from collections import deque, OrderedDict
+from threading import Lock
+
+import pika
+
+
+def _noop():
+    pass
+
+
+class OutboundPublisher:
+    """Fila de publicação drenada na thread da conexão.
+
+    O BlockingConnection do pika não é thread-safe: outras threads apenas
+    enfileiram as mensagens, e o envio acontece em lote dentro de um callback
+    agendado com add_callback_threadsafe.
+
+    O canal usa publisher confirms: cada mensagem fica guardada até o ack do
+    broker, e as que não foram confirmadas quando a conexão cai são
+    reenviadas após o rebind(). Um reenvio pode duplicar uma mensagem, então
+    quem recebe deve descartar repetidas (COMMITTED por correlation_id,
+    RELEASE por request_id).
+    """
+
+    def __init__(self, connection, channel, batch_size=256, latency=None):
+        self.batch_size = batch_size
+        self.latency = latency  # histograma opcional: publish() -> ack do broker
+        self._outbox = deque()
+        self._unconfirmed = OrderedDict()  # delivery_tag -> mensagem aguardando ack do broker
+        self._next_tag = 1
+        self._lock = Lock()
+        self._scheduled = False
+        self.rebind(connection, channel)
+
+    def rebind(self, connection, channel):
+        """Usa uma nova conexão (após reconectar) e reenvia o que ficou pendente.
+
+        Deve ser chamado na thread da conexão.
+        """
+        with self._lock:
+            self.connection = connection
+            self.channel = channel
+            self._scheduled = False
+            # O que o broker antigo não confirmou volta para a frente da fila, na ordem original
+            self._outbox.extendleft(reversed(self._unconfirmed.values()))
+            self._unconfirmed.clear()
+            self._next_tag = 1
+        self._enable_confirms()
+        if self._outbox:
+            self._schedule()
+
+    def _enable_confirms(self):
+        # Mesmo esquema do MessageBroker: confirm mode no canal interno (_impl),
+        # para o basic_publish não bloquear esperando cada ack
+        selected = []
+
+        def on_select_ok(frame):
+            selected.append(frame)
+            # O SelectOk do canal interno não acorda o process_data_events, que
+            # esperaria o time_limit inteiro; o timer de 0s o faz retornar já
+            self.connection.call_later(0, _noop)
+
+        self.channel._impl.confirm_delivery(
+            ack_nack_callback=self._on_confirm,
+            callback=on_select_ok
+        )
+        while not selected:
+            self.connection.process_data_events(time_limit=1)
+
+    def _on_confirm(self, frame):
+        # Executa na thread da conexão: Basic.Ack/Basic.Nack, possivelmente cumulativo
+        method = frame.method
+        if method.multiple:
+            tags = []
+            for tag in self._unconfirmed:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+        settled = [self._unconfirmed.pop(tag) for tag in tags if tag in self._unconfirmed]
+        if isinstance(method, pika.spec.Basic.Nack):
+            if settled:
+                self._outbox.extend(settled)  # Recusadas pelo broker: tenta de novo
+                self._schedule()
+        elif self.latency is not None:
+            now = time.monotonic()
+            for item in settled:
+                self.latency.observe(now - item[4])
+
+    def publish(self, exchange, routing_key, body, properties):
+        """Pode ser chamado de qualquer thread"""
+        self._outbox.append((exchange, routing_key, body, properties, time.monotonic()))
+        self._schedule()
+
+    def pending(self):
+        """Mensagens ainda não enviadas ou sem confirmação do broker"""
+        return len(self._outbox) + len(self._unconfirmed)
+
+    def _schedule(self):
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+            connection = self.connection
+        try:
+            connection.add_callback_threadsafe(self._drain)
+        except pika.exceptions.AMQPError:
+            # Conexão fechada: as mensagens ficam na fila até o rebind()
+            with self._lock:
+                self._scheduled = False
+
+    def _drain(self):
+        # Executa na thread da conexão
+        with self._lock:
+            self._scheduled = False
+        for _ in range(self.batch_size):
+            try:
+                item = self._outbox.popleft()
+            except IndexError:
+                return
+            exchange, routing_key, body, properties, _ = item
+            try:
+                self.channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=properties
+                )
+                self._unconfirmed[self._next_tag] = item
+                self._next_tag += 1
+            except pika.exceptions.AMQPError:
+                # Devolve a mensagem para ser reenviada após a reconexão
+                self._outbox.appendleft(item)
+                raise
+        if self._outbox:
+            self._schedule()
@@ -0,0 +1,74 @@
+import time
+
+# Tipos de evento trocados entre as réplicas pelo exchange fanout
+# (vão no campo "type" das propriedades AMQP)
+HEARTBEAT = "HEARTBEAT"   # Nó vivo; o header "leader" diz se ele é o líder
+ACQUIRE_EVENT = "ACQUIRE"  # Pedido aceito pelo líder (reply_to/correlation_id nas propriedades)
+RELEASE_EVENT = "RELEASE"  # Pedido concluído pelo líder
+SYNC_REQUEST = "SYNC"      # Nó recém-iniciado pedindo ao líder os pedidos pendentes
+SYNC_STATE = "SYNC_STATE"  # Resposta do líder: request_ids pendentes (JSON), após reenviar os ACQUIREs
+
+
+class LeaderLease:
+    """Eleição de líder por lease a partir dos heartbeats das réplicas.
+
+    Um nó é considerado vivo enquanto seu último heartbeat tiver menos de
+    `lease_timeout` segundos. Cada líder anuncia o termo em que assumiu, e
+    quem assume usa o maior termo já visto mais um. Enquanto algum nó vivo se
+    declarar líder, vence o de maior termo (empate: menor id), então um líder
+    antigo que volta de uma partição não toma o lugar do atual. Sem líder
+    vivo, assume o menor id entre os nós vivos. Um nó recém-iniciado (ou que
+    perdeu a conexão) só disputa a liderança depois de ouvir a rede por um
+    lease inteiro.
+    """
+
+    def __init__(self, node_id, lease_timeout, clock=time.monotonic):
+        self.node_id = node_id
+        self.lease_timeout = lease_timeout
+        self.clock = clock
+        self.started_at = clock()
+        self.last_seen = {}   # node_id -> (instante do último heartbeat, se declarou líder, termo)
+        self.leader = None
+        self.term = 0         # termo do líder atual
+        self.max_term = 0     # maior termo já anunciado na rede
+
+    def observe(self, node_id, claims_leader, term=0):
+        self.last_seen[node_id] = (self.clock(), claims_leader, term)
+        self.max_term = max(self.max_term, term)
+
+    def reset(self):
+        """Esquece o líder e volta a ouvir a rede por um lease inteiro"""
+        self.leader = None
+        self.last_seen.clear()
+        self.started_at = self.clock()
+
+    def update(self):
+        """Recalcula o líder; retorna True se ele mudou"""
+        now = self.clock()
+        for node_id, (seen_at, _, _) in list(self.last_seen.items()):
+            if now - seen_at > self.lease_timeout:
+                del self.last_seen[node_id]
+
+        claimants = [(term, node_id) for node_id, (_, claims, term) in self.last_seen.items() if claims]
+        if self.leader == self.node_id:
+            claimants.append((self.term, self.node_id))
+
+        term = self.term
+        if claimants:
+            term, leader = min(claimants, key=lambda claimant: (-claimant[0], claimant[1]))
+        elif now - self.started_at < self.lease_timeout:
+            leader = None  # Ainda ouvindo a rede
+        else:
+            leader = min(list(self.last_seen) + [self.node_id])
+
+        changed = leader != self.leader
+        if changed and leader == self.node_id:
+            term = self.max_term + 1  # Novo mandato
+        self.leader = leader
+        self.term = term
+        self.max_term = max(self.max_term, term)
+        return changed
+
+    @property
+    def is_leader(self):
+        return self.leader == self.node_id
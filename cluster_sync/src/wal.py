@@ -0,0 +1,261 @@
+import mmap
+import os
+import struct
+import time
+import zlib
+from threading import Event, Lock, Thread
+
+from grant_queue import PendingRequest
+from shared.log import get_logger
+from shared.protocol import DEFAULT_RESOURCE, get_codec
+
+# Tipos de registro do log
+ACQUIRE_RECORD = 1   # pedido aceito (com os dados para responder ao cliente)
+GRANT_RECORD = 2     # seção crítica concedida
+RELEASE_RECORD = 3   # pedido concluído
+
+# Cada registro: tamanho do payload (4 bytes) | crc32 do payload (4 bytes) | payload
+# Payload: tipo (1 byte) seguido de campos com tamanho de 2 bytes + bytes
+_HEADER = struct.Struct("!II")
+_TYPE = struct.Struct("!B")
+_FIELD_LEN = struct.Struct("!H")
+MAX_FIELD_BYTES = 0xFFFF
+
+
+def _encode_record(record_type, *fields):
+    parts = [_TYPE.pack(record_type)]
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode()
+        elif field is None:
+            field = b''
+        if len(field) > MAX_FIELD_BYTES:
+            raise ValueError(f"Campo de {len(field)} bytes não cabe no WAL (máximo {MAX_FIELD_BYTES})")
+        parts.append(_FIELD_LEN.pack(len(field)))
+        parts.append(field)
+    payload = b''.join(parts)
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def encode_acquire(request):
+    """Registro ACQUIRE de um pedido; ValueError se algum campo passa do limite"""
+    codec = request.codec
+    return _encode_record(
+        ACQUIRE_RECORD, codec.content_type, request.reply_to,
+        request.correlation_id, codec.encode(request.message)
+    )
+
+
+def _decode_fields(view, offset, end):
+    fields = []
+    while offset < end:
+        (length,) = _FIELD_LEN.unpack_from(view, offset)
+        offset += _FIELD_LEN.size
+        fields.append(view[offset:offset + length])
+        offset += length
+    return fields
+
+
+class WriteAheadLog:
+    """Log local, somente de acréscimo, dos eventos ACQUIRE/GRANT/RELEASE.
+
+    Os registros são acumulados em memória e gravados com um único fsync a
+    cada `fsync_interval` segundos (group commit). O log é dividido em
+    segmentos; ao trocar de segmento é gravado um snapshot com os pedidos
+    pendentes, e os segmentos e snapshots anteriores são apagados. Na
+    inicialização, o snapshot mais recente e os segmentos seguintes são
+    lidos via mmap.
+
+    after_flush() registra uma função chamada depois do próximo fsync (ex.:
+    o ack da entrega que gerou o registro). Com `max_waiters` funções
+    esperando, o fsync é antecipado em vez de aguardar o intervalo.
+    """
+
+    def __init__(self, directory, snapshot_source, segment_bytes=4 * 1024 * 1024,
+                 fsync_interval=0.05, snapshot_interval=60, max_waiters=0):
+        self.directory = directory
+        self.snapshot_source = snapshot_source  # função que devolve os PendingRequest atuais
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.max_waiters = max_waiters
+        self.log = get_logger("wal")
+
+        self._lock = Lock()
+        self._buffer = bytearray()
+        self._waiters = []       # funções a chamar depois do próximo fsync
+        self._segment = None
+        self._segment_number = 0
+        self._segment_size = 0
+        self._last_snapshot = time.monotonic()
+        self._stop = Event()
+        self._wake = Event()
+        self._flusher = None
+        os.makedirs(directory, exist_ok=True)
+
+    # ----- leitura -----
+
+    def _numbered(self, prefix):
+        numbered = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name[len(prefix):-4].isdigit():
+                numbered.append((int(name[len(prefix):-4]), os.path.join(self.directory, name)))
+        return sorted(numbered)
+
+    def replay(self):
+        """Gera os registros salvos, na ordem: (tipo, PendingRequest) ou (tipo, recurso, request_id)"""
+        snapshots = self._numbered("snapshot-")
+        start = 0
+        files = []
+        if snapshots:
+            start, path = snapshots[-1]
+            files.append(path)
+        files.extend(path for number, path in self._numbered("wal-") if number >= start)
+
+        for path in files:
+            yield from self._read_file(path)
+
+    def _read_file(self, path):
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                offset = 0
+                while offset + _HEADER.size <= len(view):
+                    length, crc = _HEADER.unpack_from(view, offset)
+                    start = offset + _HEADER.size
+                    end = start + length
+                    # Registro incompleto ou corrompido (queda no meio da escrita): para aqui
+                    if end > len(view) or zlib.crc32(view[start:end]) != crc:
+                        self.log.warning("Registro inválido em %s@%d; ignorando o resto do arquivo", path, offset)
+                        return
+                    yield self._decode_record(view, start, end)
+                    offset = end
+            finally:
+                view.release()
+
+    def _decode_record(self, view, start, end):
+        (record_type,) = _TYPE.unpack_from(view, start)
+        fields = _decode_fields(view, start + _TYPE.size, end)
+        if record_type == ACQUIRE_RECORD:
+            content_type, reply_to, correlation_id, body = fields
+            codec = get_codec(str(content_type, "utf-8"))
+            message = codec.decode(bytes(body))
+            request = PendingRequest(
+                message,
+                str(reply_to, "utf-8") or None,
+                str(correlation_id, "utf-8") or None,
+                codec
+            )
+            return (record_type, request)
+        resource, request_id = fields
+        return (record_type, str(resource, "utf-8"), str(request_id, "utf-8"))
+
+    # ----- escrita -----
+
+    def start(self):
+        """Abre um novo segmento com o snapshot do estado atual e inicia o fsync periódico"""
+        segments = self._numbered("wal-")
+        snapshots = self._numbered("snapshot-")
+        last = max([n for n, _ in segments] + [n for n, _ in snapshots] + [0])
+        self._rotate(last + 1)
+        self._flusher = Thread(target=self._run_flusher, name="wal-flusher", daemon=True)
+        self._flusher.start()
+
+    def append_acquire(self, request, record=None):
+        """record: o registro já codificado com encode_acquire(), se houver"""
+        self._append(record or encode_acquire(request))
+
+    def append_grant(self, resource, request_id):
+        self._append(_encode_record(GRANT_RECORD, resource, request_id))
+
+    def append_release(self, resource, request_id):
+        self._append(_encode_record(RELEASE_RECORD, resource, request_id))
+
+    def _append(self, record):
+        with self._lock:
+            self._buffer += record
+
+    def after_flush(self, callback):
+        """Chama callback (na thread do fsync) quando tudo o que já foi registrado estiver em disco"""
+        with self._lock:
+            self._waiters.append(callback)
+            if self.max_waiters and len(self._waiters) >= self.max_waiters:
+                self._wake.set()
+
+    def flush(self):
+        """Grava o que está em memória e faz fsync (um único fsync por lote)"""
+        with self._lock:
+            if self._buffer:
+                self._segment.write(self._buffer)
+                self._segment_size += len(self._buffer)
+                self._buffer = bytearray()
+                self._segment.flush()
+                os.fsync(self._segment.fileno())
+            # Só depois do fsync: se a gravação falhar, as funções esperam a próxima
+            waiters, self._waiters = self._waiters, []
+            rotate = self._segment_size >= self.segment_bytes or (
+                self._segment_size and time.monotonic() - self._last_snapshot >= self.snapshot_interval
+            )
+        for callback in waiters:
+            try:
+                callback()
+            except Exception as e:
+                self.log.error("Erro após o fsync: %s", e)
+        if rotate:
+            self._rotate(self._segment_number + 1)
+
+    def _run_flusher(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.fsync_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                self.log.error("Erro ao gravar o log: %s", e)
+
+    def _rotate(self, number):
+        # Troca de segmento e depois grava o snapshot do estado. O snapshot é
+        # feito fora de _lock (snapshot_source usa o lock do ClusterSync);
+        # registros que chegarem nesse meio tempo vão para o novo segmento e
+        # reaplicá-los sobre o snapshot é idempotente.
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+            self._segment = open(os.path.join(self.directory, f"wal-{number:08d}.log"), "ab")
+            self._segment_number = number
+            self._segment_size = 0
+            self._last_snapshot = time.monotonic()
+        self._write_snapshot(number)
+        self._compact(number)
+
+    def _write_snapshot(self, number):
+        path = os.path.join(self.directory, f"snapshot-{number:08d}.log")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for request in self.snapshot_source():
+                f.write(encode_acquire(request))
+                if request.granted_at is not None:
+                    # Concessões ativas também sobrevivem à compactação
+                    message = request.message
+                    f.write(_encode_record(GRANT_RECORD, message.resource or DEFAULT_RESOURCE, message.request_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)  # Troca atômica: nunca existe snapshot pela metade
+
+    def _compact(self, number):
+        # Tudo antes do snapshot `number` já está contido nele
+        for prefix in ("wal-", "snapshot-"):
+            for n, path in self._numbered(prefix):
+                if n < number:
+                    os.remove(path)
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        with self._lock:
+            self._segment.close()
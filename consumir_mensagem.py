@@ -1,28 +1,43 @@
-import pika
+import os
+from shared.consumer_engine import ConsumerEngine
 
-def callback(ch, method, properties, body):
-    print(f"[x] Fila: {method.routing_key} | Mensagem: {body.decode()}")
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+# Ajuste de desempenho: quantas mensagens o broker entrega sem ack e de
+# quantas em quantas (ou a cada quantos ms) os acks são enviados em lote
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "1"))
+ACK_BATCH_SIZE = int(os.getenv("ACK_BATCH_SIZE", "1"))
+ACK_INTERVAL_MS = int(os.getenv("ACK_INTERVAL_MS", "0"))
+# Paralelismo: as filas são divididas entre CONSUMER_WORKERS threads ou
+# processos (CONSUMER_MODE=thread|process); 0 = uma thread por fila ou um
+# processo por núcleo
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", "0"))
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "thread")
+# Handler de cada mensagem como "módulo:função" (padrão: imprime a mensagem)
+CONSUMER_HANDLER = os.getenv("CONSUMER_HANDLER", "consumir_mensagem:callback")
+# Fila que recebe as mensagens cujo handler falha também na reentrega
+# (vazio = a mensagem volta sempre para a fila de origem)
+DEAD_LETTER_QUEUE = os.getenv("DEAD_LETTER_QUEUE", "")
+REPORT_INTERVAL = float(os.getenv("REPORT_INTERVAL", "5"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
-def consumir_varias_filas(filas):
-    credenciais = pika.PlainCredentials('Nicole', 'nicole123')
-    parametros = pika.ConnectionParameters('localhost', credentials=credenciais)
-    conexao = pika.BlockingConnection(parametros)
-    canal = conexao.channel()
-
-    for fila in filas:
-        canal.queue_declare(queue=fila)
-        canal.basic_consume(queue=fila, on_message_callback=callback, auto_ack=False)
-        print(f"[*] Escutando fila: {fila}")
+def callback(fila, properties, body):
+    print(f"[x] Fila: {fila} | Mensagem: {body.decode()}")
 
+def consumir_varias_filas(filas):
+    engine = ConsumerEngine(
+        filas,
+        CONSUMER_HANDLER,
+        workers=CONSUMER_WORKERS,
+        use_processes=CONSUMER_MODE == "process",
+        prefetch_count=PREFETCH_COUNT,
+        ack_batch_size=ACK_BATCH_SIZE,
+        ack_interval_ms=ACK_INTERVAL_MS,
+        report_interval=REPORT_INTERVAL,
+        metrics_port=METRICS_PORT,
+        dead_letter_queue=DEAD_LETTER_QUEUE,
+        host='localhost'
+    )
     print(" [*] Aguardando mensagens. Para sair, pressione CTRL+C")
-
-    try:
-        canal.start_consuming()
-    except KeyboardInterrupt:
-        print(" [!] Interrompido pelo usuário.")
-        canal.stop_consuming()
-        conexao.close()
+    engine.run()
 
 if __name__ == "__main__":
     filas = input("Digite os nomes das filas separadas por vírgula: ").split(",")
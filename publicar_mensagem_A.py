@@ -1,4 +1,4 @@
-import pika
+from shared.connection_pool import ConnectionPool
 
 def publicar_mensagem(mensagem, canal, fila='minha_fila_A'):
     canal.basic_publish(exchange='',
@@ -7,10 +7,8 @@ def publicar_mensagem(mensagem, canal, fila='minha_fila_A'):
     print(f"Mensagem enviada para a fila '{fila}': {mensagem}")
 
 def main():
-    credenciais = pika.PlainCredentials('Nicole', 'nicole123')
-    parametros = pika.ConnectionParameters('localhost', credentials=credenciais)
-    conexao = pika.BlockingConnection(parametros)
-    canal = conexao.channel()
+    pool = ConnectionPool('localhost')
+    canal = pool.acquire()
     canal.queue_declare(queue='minha_fila')
 
     print("Digite as mensagens para enviar à fila RabbitMQ.")
@@ -22,7 +20,7 @@ def main():
             break
         publicar_mensagem(mensagem, canal)
 
-    conexao.close()
+    pool.close()
     print("Conexão encerrada.")
 
 if __name__ == "__main__":
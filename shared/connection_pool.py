@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+
+import pika
+
+from shared.log import get_logger
+
+
+def backoff_delay(attempt, base, cap):
+    """Espera antes da tentativa `attempt` (0, 1, ...): exponencial com jitter completo"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def backoff_delays(base, cap, attempts):
+    for attempt in range(attempts):
+        yield backoff_delay(attempt, base, cap)
+
+
+class PikaTransport:
+    """Transporte padrão: conexões TCP com o RabbitMQ"""
+
+    def connect(self, parameters):
+        return pika.BlockingConnection(parameters)
+
+
+# Pool de conexões/canais compartilhado pelos componentes.
+# A BlockingConnection do pika não é thread-safe, então cada thread recebe a
+# sua própria conexão (aberta só no primeiro uso) e os canais são emprestados
+# dessa conexão. Canais devolvidos ficam guardados para o próximo empréstimo,
+# evitando um novo handshake TCP+AMQP (ou um Channel.Open) por tarefa.
+# O transporte abre as conexões: PikaTransport (padrão) ou um MemoryBroker
+# (shared/memory_broker.py), que atende tudo no próprio processo.
+class ConnectionPool:
+    def __init__(self, host='rabbitmq', username='Nicole', password='nicole123', port=5672,
+                 max_retries=5, backoff_base=0.5, backoff_max=10.0, transport=None, **parameters):
+        self.transport = transport or PikaTransport()
+        self.parameters = pika.ConnectionParameters(
+            host=host,
+            port=port,
+            credentials=pika.PlainCredentials(username, password),
+            connection_attempts=1,  # As novas tentativas são feitas pelo pool, com backoff
+            **parameters
+        )
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.log = get_logger("pool")
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()  # todas as conexões abertas, para close()
+
+    def connection(self):
+        """Conexão da thread atual; abre (ou reabre) se não houver uma saudável"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and connection.is_open:
+            return connection
+        if connection is not None:
+            self.invalidate()  # Conexão caiu: descarta e abre outra
+        connection = self._open()
+        self._local.connection = connection
+        self._local.idle = []
+        with self._lock:
+            self._connections.add(connection)
+        return connection
+
+    def _open(self):
+        last_error = None
+        delays = backoff_delays(self.backoff_base, self.backoff_max, self.max_retries - 1)
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                return self.transport.connect(self.parameters)
+            except pika.exceptions.AMQPConnectionError as e:
+                last_error = e
+                self.log.warning(
+                    "Tentativa %d/%d - Erro ao conectar em %s: %s",
+                    attempt, self.max_retries, self.parameters.host, e
+                )
+                delay = next(delays, None)
+                if delay is not None:
+                    time.sleep(delay)
+        raise pika.exceptions.AMQPConnectionError(
+            f"Não foi possível conectar ao RabbitMQ após {self.max_retries} tentativas: {last_error}"
+        )
+
+    def acquire(self):
+        """Empresta um canal aberto da conexão da thread atual"""
+        connection = self.connection()
+        idle = self._local.idle
+        while idle:
+            channel = idle.pop()
+            if channel.is_open:
+                return channel
+        return connection.channel()
+
+    def release(self, channel):
+        """Devolve o canal ao pool (canais fechados são descartados)"""
+        if channel.is_open and channel.connection is getattr(self._local, "connection", None):
+            self._local.idle.append(channel)
+
+    def invalidate(self):
+        """Descarta a conexão da thread atual (a próxima chamada reconecta)"""
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        self._local.idle = []
+        if connection is None:
+            return
+        with self._lock:
+            self._connections.discard(connection)
+        try:
+            if connection.is_open:
+                connection.close()
+        except pika.exceptions.AMQPError:
+            pass  # A conexão já estava quebrada
+
+    def close(self):
+        """Fecha todas as conexões abertas pelo pool (no encerramento do processo)"""
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for connection in connections:
+            try:
+                if connection.is_open:
+                    connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+        self._local = threading.local()
@@ -0,0 +1,216 @@
+import importlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from functools import partial
+
+import pika
+
+from shared.connection_pool import ConnectionPool
+from shared.log import get_logger
+from shared.messaging import BatchAcker
+from shared.metrics import Registry, start_http_server
+
+# Consumo paralelo de várias filas. As filas são divididas entre `workers`
+# threads ou processos; cada worker tem a sua própria conexão e um canal por
+# fila, com prefetch e acks em lote próprios, então uma fila lenta só segura
+# o seu worker. Com processos, o consumo usa vários núcleos.
+# O handler recebe (fila, properties, body); uma exceção devolve a mensagem
+# à fila. Com `dead_letter_queue`, a mensagem que falha de novo na reentrega
+# é copiada para essa fila e confirmada, em vez de voltar indefinidamente.
+# Os workers mandam a contagem por fila ao processo principal, que
+# publica o contador consumer_messages_total{queue} e loga a vazão.
+
+
+def load_handler(spec):
+    """Resolve "módulo:função" para a função (callables são devolvidos como estão)"""
+    if callable(spec):
+        return spec
+    module_name, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), name)
+
+
+def assign_queues(queues, workers):
+    """Divide as filas entre os workers em rodízio"""
+    assignments = [[] for _ in range(min(workers, len(queues)))]
+    for index, name in enumerate(queues):
+        assignments[index % len(assignments)].append(name)
+    return assignments
+
+
+def on_message(name, handler, acker, counts, log, dead_letter_queue, ch, method, properties, body):
+    try:
+        handler(name, properties, body)
+    except Exception as e:
+        log.error("Erro no handler da fila %s: %s", name, e)
+        if dead_letter_queue and method.redelivered:
+            headers = dict(properties.headers or {})
+            headers["x-death-reason"] = str(e)
+            headers["x-first-queue"] = name
+            ch.basic_publish(
+                exchange='', routing_key=dead_letter_queue, body=body,
+                properties=pika.BasicProperties(
+                    content_type=properties.content_type, headers=headers, delivery_mode=2
+                )
+            )
+            acker.ack(method.delivery_tag)
+        else:
+            acker.nack(method.delivery_tag)
+        return
+    acker.ack(method.delivery_tag)
+    counts[name] += 1
+
+
+def run_worker(worker_id, queues, handler, settings, stats, stop):
+    """Corpo de um worker (thread ou processo): consome as suas filas até o stop"""
+    log = get_logger(f"consumer_{worker_id}")
+    handler = load_handler(handler)
+    pool = ConnectionPool(transport=settings.get("transport"), **settings["connection"])
+    connection = pool.connection()
+    counts = Counter()
+    ackers = []
+    dead_letter_queue = settings["dead_letter_queue"]
+    try:
+        for name in queues:
+            channel = pool.acquire()
+            channel.basic_qos(prefetch_count=settings["prefetch_count"])
+            acker = BatchAcker(
+                connection, channel, settings["prefetch_count"], settings["ack_batch_size"],
+                settings["ack_interval_ms"]
+            )
+            ackers.append(acker)
+            channel.queue_declare(queue=name)
+            if dead_letter_queue:
+                channel.queue_declare(queue=dead_letter_queue, durable=True)
+            channel.basic_consume(
+                queue=name,
+                on_message_callback=partial(on_message, name, handler, acker, counts, log, dead_letter_queue),
+                auto_ack=False
+            )
+            log.info("Escutando fila: %s", name)
+
+        report_interval = settings["report_interval"]
+        next_report = time.monotonic() + report_interval
+        while not stop.is_set():
+            connection.process_data_events(time_limit=min(0.5, report_interval))
+            if time.monotonic() >= next_report:
+                next_report += report_interval
+                if counts:
+                    stats.put(dict(counts))
+                    counts.clear()
+    except KeyboardInterrupt:
+        pass  # O processo principal também recebe o CTRL+C e encerra os workers
+    finally:
+        try:
+            for acker in ackers:
+                acker.flush()
+        finally:
+            if counts:
+                stats.put(dict(counts))
+            pool.close()
+
+
+class ConsumerEngine:
+    def __init__(self, queues, handler, workers=0, use_processes=False, prefetch_count=1,
+                 ack_batch_size=1, ack_interval_ms=0, report_interval=5.0, metrics_port=0,
+                 dead_letter_queue=None, transport=None, **connection):
+        self.queues = list(queues)
+        self.handler = handler   # callable ou "módulo:função" (com processos, precisa ser importável)
+        self.use_processes = use_processes
+        if not workers:
+            # Padrão: uma thread por fila ou um processo por núcleo
+            workers = (os.cpu_count() or 1) if use_processes else len(self.queues)
+        self.assignments = assign_queues(self.queues, workers)
+        self.report_interval = report_interval
+        self.settings = {
+            "connection": connection,        # argumentos do ConnectionPool (host, username, ...)
+            "transport": None if use_processes else transport,
+            "prefetch_count": prefetch_count,
+            "ack_batch_size": ack_batch_size,
+            "ack_interval_ms": ack_interval_ms,
+            "dead_letter_queue": dead_letter_queue,
+            "report_interval": report_interval
+        }
+        self.log = get_logger("consumer")
+        self.metrics = Registry()
+        self.consumed = self.metrics.counter("consumer_messages_total", "Mensagens processadas por fila", ("queue",))
+        self.totals = Counter()
+        if metrics_port:
+            start_http_server(self.metrics, metrics_port)
+
+        if use_processes:
+            self.stats = multiprocessing.Queue()
+            self.stop = multiprocessing.Event()
+            worker_class = multiprocessing.Process
+        else:
+            self.stats = queue.Queue()
+            self.stop = threading.Event()
+            worker_class = threading.Thread
+        self.workers = [
+            worker_class(
+                target=run_worker, name=f"consumer-{worker_id}",
+                args=(worker_id, names, handler, self.settings, self.stats, self.stop), daemon=True
+            )
+            for worker_id, names in enumerate(self.assignments)
+        ]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.log.info(
+            "%d filas em %d %s", len(self.queues), len(self.workers),
+            "processos" if self.use_processes else "threads"
+        )
+
+    def collect(self, timeout):
+        """Soma as contagens enviadas pelos workers; retorna as deste intervalo"""
+        interval = Counter()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                counts = self.stats.get(timeout=max(remaining, 0)) if remaining > 0 else self.stats.get_nowait()
+            except queue.Empty:
+                break
+            interval.update(counts)
+        for name, count in interval.items():
+            self.consumed.labels(name).inc(count)
+        self.totals.update(interval)
+        return interval
+
+    def report(self, interval, elapsed):
+        for name in self.queues:
+            if interval[name]:
+                self.log.info(
+                    "Fila %s: %d mensagens (%.1f/s), %d no total", name, interval[name],
+                    interval[name] / elapsed, self.totals[name]
+                )
+
+    def shutdown(self):
+        self.stop.set()
+        for worker in self.workers:
+            # Continua lendo as contagens: um processo com itens na fila não termina
+            while worker.is_alive():
+                self.collect(0.1)
+                worker.join(0.1)
+        self.collect(0)
+        for name in self.queues:
+            self.log.info("Fila %s: %d mensagens no total", name, self.totals[name])
+
+    def run(self):
+        """Inicia os workers e reporta a vazão por fila até o CTRL+C"""
+        self.start()
+        try:
+            last = time.monotonic()
+            while any(worker.is_alive() for worker in self.workers):
+                interval = self.collect(self.report_interval)
+                now = time.monotonic()
+                self.report(interval, now - last)
+                last = now
+        except KeyboardInterrupt:
+            self.log.info("Interrompido pelo usuário.")
+        finally:
+            self.shutdown()
@@ -0,0 +1,59 @@
+import json
+import logging
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+# Log estruturado (uma linha JSON por registro) com filtro de nível e
+# amostragem. Mensagens por pedido vão em DEBUG e passam pela amostragem
+# (LOG_SAMPLE_RATE); eventos de ciclo de vida (conexão, liderança, erros)
+# vão em INFO ou acima e nunca são descartados.
+#   LOG_LEVEL: DEBUG, INFO, WARNING... (padrão INFO)
+#   LOG_SAMPLE_RATE: fração dos registros DEBUG mantida (padrão 1.0)
+#   LOG_FORMAT: json (padrão) ou text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "component": record.name,
+            "msg": record.getMessage()
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update((key, value) for key, value in fields.items() if value is not None)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+class SamplingFilter(logging.Filter):
+    """Mantém só uma fração dos registros DEBUG"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+def get_logger(component):
+    """Logger do componente (ex.: o SYNC_ID ou o CLIENT_ID), configurado pelo ambiente"""
+    logger = logging.getLogger(component)
+    if logger.handlers:
+        return logger
+    handler = logging.StreamHandler(sys.stdout)
+    if os.getenv("LOG_FORMAT", "json") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("[%(name)s] %(message)s"))
+    logger.addHandler(handler)
+    # No logger (e não no handler), para descartar antes de formatar
+    logger.addFilter(SamplingFilter(float(os.getenv("LOG_SAMPLE_RATE", "1.0"))))
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+    return logger
@@ -0,0 +1,576 @@
+import copy
+import heapq
+import itertools
+import threading
+import time
+import zlib
+from collections import deque, OrderedDict
+from functools import partial
+
+import pika
+
+# Broker AMQP em memória, para rodar clientes e cluster_sync no mesmo
+# processo, sem rede e de forma determinística (testes e benchmarks).
+# MemoryConnection e MemoryChannel imitam a parte da API da BlockingConnection
+# do pika usada no projeto: fila/exchange padrão, fanout, direct e
+# x-consistent-hash, reply_to e correlation_id (nas propriedades), a
+# pseudo-fila amq.rabbitmq.reply-to (direct reply-to), ack/nack (inclusive
+# multiple), prefetch por consumidor, TTL das filas e publisher confirms.
+# Os callbacks rodam na thread que chama process_data_events, como no
+# pika; os erros são as mesmas exceções de pika.exceptions.
+
+
+# Direct reply-to: consumir desta pseudo-fila (com auto_ack) dá ao canal uma
+# fila de respostas própria; publicar com reply_to igual a ela troca o
+# reply_to pelo nome dessa fila, como faz o RabbitMQ
+DIRECT_REPLY_TO = "amq.rabbitmq.reply-to"
+
+
+class _Message:
+    __slots__ = ("body", "properties", "exchange", "routing_key", "expires_at", "redelivered")
+
+    def __init__(self, body, properties, exchange, routing_key, expires_at):
+        self.body = body
+        self.properties = properties
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.expires_at = expires_at
+        self.redelivered = False
+
+
+class _Consumer:
+    __slots__ = ("tag", "channel", "queue", "callback", "auto_ack", "prefetch", "unacked")
+
+    def __init__(self, tag, channel, queue, callback, auto_ack, prefetch):
+        self.tag = tag
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.prefetch = prefetch
+        self.unacked = 0
+
+    def has_capacity(self):
+        return self.auto_ack or not self.prefetch or self.unacked < self.prefetch
+
+
+class _Queue:
+    def __init__(self, name, ttl, exclusive_owner, auto_delete):
+        self.name = name
+        self.ttl = ttl                      # segundos (x-message-ttl) ou None
+        self.exclusive_owner = exclusive_owner
+        self.auto_delete = auto_delete
+        self.messages = deque()
+        self.consumers = []
+        self.next_consumer = 0              # rodízio entre os consumidores
+
+
+class MemoryBroker:
+    """Estado do broker: filas, exchanges e bindings, protegidos por um único lock"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.exchanges = {}          # nome -> tipo
+        self.bindings = {}           # exchange -> lista de (fila, routing_key)
+        self.connections = set()
+        self._names = itertools.count(1)
+
+    def connect(self, parameters=None):
+        """Mesmo papel de pika.BlockingConnection(parameters)"""
+        connection = MemoryConnection(self)
+        with self.lock:
+            self.connections.add(connection)
+        return connection
+
+    def drop_connections(self):
+        """Derruba todas as conexões, como numa queda do broker"""
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            self.drop_connection(connection)
+
+    def drop_connection(self, connection):
+        """Derruba uma só conexão, como uma falha de rede entre o nó e o broker"""
+        with self.lock:
+            self.connections.discard(connection)
+        if connection.is_open:
+            connection._lost()
+
+    def node(self):
+        """Transporte próprio de um nó simulado, que cai e volta sem afetar os outros"""
+        return MemoryNode(self)
+
+    def unique_name(self, prefix):
+        return f"{prefix}{next(self._names)}"
+
+    # ----- roteamento e entrega (chamar com self.lock) -----
+
+    def route(self, exchange, routing_key):
+        if exchange == '':
+            queue = self.queues.get(routing_key)
+            return [queue] if queue is not None else []
+        exchange_type = self.exchanges.get(exchange)
+        if exchange_type is None:
+            raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no exchange '{exchange}'")
+        bound = [(self.queues[name], key) for name, key in self.bindings.get(exchange, ()) if name in self.queues]
+        if exchange_type == 'fanout':
+            return [queue for queue, _ in bound]
+        if exchange_type == 'x-consistent-hash':
+            # A routing key do bind é o peso; o recurso cai sempre na mesma fila
+            ring = [queue for queue, weight in bound for _ in range(int(weight or 1))]
+            if not ring:
+                return []
+            return [ring[zlib.crc32(routing_key.encode()) % len(ring)]]
+        return [queue for queue, key in bound if key == routing_key]
+
+    def dispatch(self, queue):
+        """Entrega as mensagens da fila aos consumidores com prefetch livre"""
+        consumers = queue.consumers
+        now = None
+        while queue.messages and consumers:
+            message = queue.messages[0]
+            if message.expires_at is not None:
+                now = now or time.monotonic()
+                if message.expires_at <= now:
+                    queue.messages.popleft()  # TTL vencido: descartada
+                    continue
+            consumer = None
+            for i in range(len(consumers)):
+                candidate = consumers[(queue.next_consumer + i) % len(consumers)]
+                if candidate.has_capacity():
+                    consumer = candidate
+                    queue.next_consumer = (queue.next_consumer + i + 1) % len(consumers)
+                    break
+            if consumer is None:
+                return
+            queue.messages.popleft()
+            consumer.channel._deliver(consumer, message)
+
+    def delete_queue(self, queue):
+        self.queues.pop(queue.name, None)
+        for bindings in self.bindings.values():
+            bindings[:] = [(name, key) for name, key in bindings if name != queue.name]
+
+
+class MemoryNode:
+    """Transporte de um só nó (um ClusterSync, um cliente) sobre o MemoryBroker.
+
+    drop() derruba as conexões do nó, que pode reconectar na hora; down()
+    derruba e recusa novas conexões até up(), como um processo parado.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_up = True
+        self.connections = []
+
+    def connect(self, parameters=None):
+        if not self.is_up:
+            raise pika.exceptions.AMQPConnectionError("Nó fora do ar")
+        connection = self.broker.connect(parameters)
+        self.connections = [c for c in self.connections if c.is_open] + [connection]
+        return connection
+
+    def drop(self):
+        for connection in self.connections:
+            self.broker.drop_connection(connection)
+        self.connections = []
+
+    def down(self):
+        self.is_up = False
+        self.drop()
+
+    def up(self):
+        self.is_up = True
+
+
+class MemoryConnection:
+    """Imita a BlockingConnection: callbacks, timers e entregas rodam em process_data_events"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self._events = deque()       # callables a executar na thread da conexão
+        self._wakeup = threading.Condition(broker.lock)
+        self._timers = []            # heap [instante, seq, callback]
+        self._timer_seq = itertools.count()
+        self._channels = []
+        self._channel_numbers = itertools.count(1)
+        self._lost_connection = False
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self):
+        self._check_open()
+        channel = MemoryChannel(self, next(self._channel_numbers))
+        self._channels.append(channel)
+        return channel
+
+    def _check_open(self):
+        if self._lost_connection:
+            raise pika.exceptions.StreamLostError("Conexão com o broker em memória perdida")
+        if not self.is_open:
+            raise pika.exceptions.ConnectionWrongStateError("Conexão fechada")
+
+    def _post(self, callback):
+        # Chamar com broker.lock
+        self._events.append(callback)
+        self._wakeup.notify()
+
+    def add_callback_threadsafe(self, callback):
+        with self._wakeup:
+            self._check_open()
+            self._post(callback)
+
+    def call_later(self, delay, callback):
+        with self._wakeup:
+            timer = [time.monotonic() + delay, next(self._timer_seq), callback]
+            heapq.heappush(self._timers, timer)
+            self._wakeup.notify()
+        return timer
+
+    def remove_timeout(self, timer):
+        timer[2] = None  # Removido do heap quando vencer
+
+    def process_data_events(self, time_limit=0):
+        """Executa o que estiver pronto; espera até time_limit (None = até o próximo evento)"""
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        while True:
+            with self._wakeup:
+                self._check_open()
+                ready = self._take_ready()
+                if not ready:
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        return
+                    timeout = None if deadline is None else deadline - now
+                    if self._timers:
+                        until_timer = max(self._timers[0][0] - now, 0)
+                        timeout = until_timer if timeout is None else min(timeout, until_timer)
+                    self._wakeup.wait(timeout)
+                    continue
+            for callback in ready:
+                callback()
+            return
+
+    def _take_ready(self):
+        # Chamar com broker.lock
+        ready = list(self._events)
+        self._events.clear()
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            callback = heapq.heappop(self._timers)[2]
+            if callback is not None:
+                ready.append(callback)
+        return ready
+
+    def sleep(self, duration):
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.process_data_events(time_limit=remaining)
+
+    def close(self):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionWrongStateError("Conexão já fechada")
+        self._shutdown()
+
+    def _lost(self):
+        self._lost_connection = True
+        self._shutdown()
+
+    def _shutdown(self):
+        with self._wakeup:
+            self.is_open = False
+            for channel in self._channels:
+                channel._shutdown()
+            # Filas exclusivas morrem com a conexão
+            for queue in list(self.broker.queues.values()):
+                if queue.exclusive_owner is self:
+                    self.broker.delete_queue(queue)
+            self.broker.connections.discard(self)
+            self._events.clear()
+            self._wakeup.notify_all()
+
+
+class _ConfirmImpl:
+    """Equivalente ao channel._impl do pika, só para confirm_delivery"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        channel = self.channel
+        with channel.connection._wakeup:
+            channel._confirm_callback = ack_nack_callback
+            if callback is not None:
+                frame = pika.frame.Method(channel.channel_number, pika.spec.Confirm.SelectOk())
+                channel.connection._post(partial(callback, frame))
+
+
+class MemoryChannel:
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self.is_open = True
+        self.prefetch_count = 0
+        self._consumers = {}             # consumer_tag -> _Consumer
+        self._unacked = OrderedDict()    # delivery_tag -> (_Consumer, _Message)
+        self._delivery_tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self._confirm_callback = None
+        self._publish_seq = 0
+        self._reply_to = None            # fila do direct reply-to deste canal
+        self._impl = _ConfirmImpl(self)
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def _check_open(self):
+        self.connection._check_open()
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Canal fechado")
+
+    def _fail(self, reply_code, reply_text):
+        # Como no RabbitMQ, um erro de canal fecha o canal
+        self._shutdown()
+        raise pika.exceptions.ChannelClosedByBroker(reply_code, reply_text)
+
+    # ----- topologia -----
+
+    def queue_declare(self, queue='', passive=False, durable=False, exclusive=False,
+                      auto_delete=False, arguments=None):
+        broker = self.broker
+        with broker.lock:
+            self._check_open()
+            existing = broker.queues.get(queue) if queue else None
+            if passive and existing is None:
+                self._fail(404, f"NOT_FOUND - no queue '{queue}'")
+            if existing is None:
+                name = queue or broker.unique_name("amq.gen-")
+                ttl = (arguments or {}).get('x-message-ttl')
+                existing = broker.queues[name] = _Queue(
+                    name,
+                    ttl / 1000 if ttl is not None else None,
+                    self.connection if exclusive else None,
+                    auto_delete
+                )
+            method = pika.spec.Queue.DeclareOk(existing.name, len(existing.messages), len(existing.consumers))
+        return pika.frame.Method(self.channel_number, method)
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, arguments=None):
+        broker = self.broker
+        with broker.lock:
+            self._check_open()
+            if passive and exchange not in broker.exchanges:
+                self._fail(404, f"NOT_FOUND - no exchange '{exchange}'")
+            broker.exchanges.setdefault(exchange, exchange_type)
+            broker.bindings.setdefault(exchange, [])
+        return pika.frame.Method(self.channel_number, pika.spec.Exchange.DeclareOk())
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        broker = self.broker
+        with broker.lock:
+            self._check_open()
+            if queue not in broker.queues:
+                self._fail(404, f"NOT_FOUND - no queue '{queue}'")
+            if exchange not in broker.exchanges:
+                self._fail(404, f"NOT_FOUND - no exchange '{exchange}'")
+            binding = (queue, routing_key if routing_key is not None else queue)
+            if binding not in broker.bindings[exchange]:
+                broker.bindings[exchange].append(binding)
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.BindOk())
+
+    def queue_purge(self, queue):
+        with self.broker.lock:
+            self._check_open()
+            purged = self.broker.queues[queue].messages
+            count = len(purged)
+            purged.clear()
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.PurgeOk(count))
+
+    # ----- publicação -----
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        properties = properties or pika.BasicProperties()
+        if isinstance(body, str):
+            body = body.encode()  # Como o pika, que publica texto em UTF-8
+        broker = self.broker
+        with broker.lock:
+            self._check_open()
+            try:
+                queues = broker.route(exchange, routing_key)
+            except pika.exceptions.ChannelClosedByBroker as e:
+                self._fail(e.reply_code, e.reply_text)
+            if properties.reply_to == DIRECT_REPLY_TO:
+                if self._reply_to is None:
+                    self._fail(406, "PRECONDITION_FAILED - fast reply consumer does not exist")
+                properties = copy.copy(properties)
+                properties.reply_to = self._reply_to
+            now = time.monotonic()
+            for queue in queues:
+                ttl = queue.ttl
+                if properties.expiration is not None:
+                    expiration = int(properties.expiration) / 1000
+                    ttl = expiration if ttl is None else min(ttl, expiration)
+                queue.messages.append(_Message(
+                    body, properties, exchange, routing_key,
+                    now + ttl if ttl is not None else None
+                ))
+                broker.dispatch(queue)
+            if self._confirm_callback is not None:
+                self._publish_seq += 1
+                frame = pika.frame.Method(self.channel_number, pika.spec.Basic.Ack(delivery_tag=self._publish_seq))
+                self.connection._post(partial(self._confirm_callback, frame))
+
+    # ----- consumo -----
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self._check_open()
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, exclusive=False,
+                      consumer_tag=None, arguments=None):
+        broker = self.broker
+        with broker.lock:
+            self._check_open()
+            if queue == DIRECT_REPLY_TO:
+                queue = self._direct_reply_queue(auto_ack)
+            target = broker.queues.get(queue)
+            if target is None:
+                self._fail(404, f"NOT_FOUND - no queue '{queue}'")
+            tag = consumer_tag or f"ctag{self.channel_number}.{next(self._consumer_tags)}"
+            consumer = _Consumer(tag, self, target, on_message_callback, auto_ack, self.prefetch_count)
+            self._consumers[tag] = consumer
+            target.consumers.append(consumer)
+            broker.dispatch(target)
+        return tag
+
+    def _direct_reply_queue(self, auto_ack):
+        # Chamar com broker.lock: fila oculta, exclusiva e removida com o consumidor
+        if not auto_ack:
+            self._fail(406, "PRECONDITION_FAILED - reply consumer cannot acknowledge")
+        if self._reply_to is not None:
+            self._fail(406, "PRECONDITION_FAILED - reply consumer already set")
+        name = self.broker.unique_name(DIRECT_REPLY_TO + ".")
+        self.broker.queues[name] = _Queue(name, None, self.connection, auto_delete=True)
+        self._reply_to = name
+        return name
+
+    def basic_cancel(self, consumer_tag):
+        with self.broker.lock:
+            self._cancel(consumer_tag)
+
+    def _cancel(self, consumer_tag):
+        # Chamar com broker.lock
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is None:
+            return
+        queue = consumer.queue
+        queue.consumers.remove(consumer)
+        queue.next_consumer = 0
+        if queue.auto_delete and not queue.consumers:
+            self.broker.delete_queue(queue)
+        if queue.name == self._reply_to:
+            self._reply_to = None
+
+    def _deliver(self, consumer, message):
+        # Chamar com broker.lock: registra a entrega e agenda o callback
+        delivery_tag = next(self._delivery_tags)
+        if not consumer.auto_ack:
+            consumer.unacked += 1
+            self._unacked[delivery_tag] = (consumer, message)
+        method = pika.spec.Basic.Deliver(
+            consumer_tag=consumer.tag,
+            delivery_tag=delivery_tag,
+            redelivered=message.redelivered,
+            exchange=message.exchange,
+            routing_key=message.routing_key
+        )
+        self.connection._post(partial(self._invoke, consumer, method, message))
+
+    def _invoke(self, consumer, method, message):
+        # Como no RabbitMQ, o que já foi entregue chega mesmo após o basic_cancel
+        if self.is_open:
+            consumer.callback(self, method, message.properties, message.body)
+
+    def _settle(self, delivery_tag, multiple):
+        # Chamar com broker.lock: remove e devolve as entregas confirmadas
+        if multiple:
+            tags = []
+            for tag in self._unacked:
+                if delivery_tag and tag > delivery_tag:
+                    break
+                tags.append(tag)
+        elif delivery_tag in self._unacked:
+            tags = [delivery_tag]
+        else:
+            self._fail(406, f"PRECONDITION_FAILED - unknown delivery tag {delivery_tag}")
+        settled = []
+        for tag in tags:
+            consumer, message = self._unacked.pop(tag)
+            consumer.unacked -= 1
+            settled.append((consumer, message))
+        return settled
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        broker = self.broker
+        with broker.lock:
+            self._check_open()
+            queues = {consumer.queue for consumer, _ in self._settle(delivery_tag, multiple)}
+            for queue in queues:
+                broker.dispatch(queue)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        broker = self.broker
+        with broker.lock:
+            self._check_open()
+            settled = self._settle(delivery_tag, multiple)
+            self._requeue(settled if requeue else [])
+            for queue in {consumer.queue for consumer, _ in settled}:
+                broker.dispatch(queue)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.basic_nack(delivery_tag, requeue=requeue)
+
+    def _requeue(self, settled):
+        # Devolvidas para a frente da fila, na ordem original
+        for consumer, message in reversed(settled):
+            message.redelivered = True
+            consumer.queue.messages.appendleft(message)
+
+    def start_consuming(self):
+        while self._consumers:
+            self.connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self):
+        with self.broker.lock:
+            for tag in list(self._consumers):
+                self._cancel(tag)
+
+    def close(self):
+        with self.broker.lock:
+            self._shutdown()
+
+    def _shutdown(self):
+        # Chamar com broker.lock: cancela os consumidores e devolve o que não teve ack
+        if not self.is_open:
+            return
+        self.is_open = False
+        settled = [self._unacked.pop(tag) for tag in list(self._unacked)]
+        for consumer, message in settled:
+            consumer.unacked -= 1
+        for tag in list(self._consumers):
+            self._cancel(tag)
+        self._requeue(settled)
+        for queue in {consumer.queue for consumer, _ in settled}:
+            if queue.name in self.broker.queues:
+                self.broker.dispatch(queue)
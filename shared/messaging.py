@@ -1,14 +1,32 @@
 import pika  # Biblioteca para interação com o RabbitMQ
 import json  # Para serializar e desserializar mensagens no formato JSON
+import time
+
+from shared.connection_pool import ConnectionPool
+
+
+def _noop():
+    pass
 
 # Classe que encapsula a comunicação com o RabbitMQ
 class MessageBroker:
-    def __init__(self, host='rabbitmq', username='Nicole', password='nicole123'):
-        credentials = pika.PlainCredentials(username, password)
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=host, credentials=credentials)
-        )
-        self.channel = self.connection.channel()
+    def __init__(self, host='rabbitmq', username='Nicole', password='nicole123', pool=None):
+        # Sem um pool compartilhado, o broker cria (e fecha) o seu próprio
+        self.owns_pool = pool is None
+        self.pool = pool or ConnectionPool(host, username, password)
+        self.connection = self.pool.connection()
+        self.channel = self.pool.acquire()
+
+        # Propriedades e encoder reutilizados em todas as publicações
+        self.persistent_properties = pika.BasicProperties(delivery_mode=2)
+        self.encode = json.JSONEncoder(separators=(',', ':')).encode
+
+        # Canal com publisher confirms, criado sob demanda por publish_batch
+        self.confirm_channel = None
+        self.unconfirmed = {}   # delivery_tag -> mensagem aguardando ack do broker
+        self.nacked = []        # mensagens recusadas pelo broker
+        self.next_delivery_tag = 1
+        self.wake_below = -1    # acorda publish_batch quando unconfirmed cair abaixo disso
 
     # Declara uma fila no servidor RabbitMQ (se já existir, não tem problema)
     def declare_queue(self, queue_name):
@@ -19,26 +37,178 @@ class MessageBroker:
         self.channel.basic_publish(
             exchange='',                 # Exchange padrão (direta, fila com o mesmo nome do routing_key)
             routing_key=queue_name,     # Nome da fila de destino
-            body=json.dumps(message),   # Converte o dicionário Python para uma string JSON
-            properties=pika.BasicProperties(delivery_mode=2)  # delivery_mode=2 torna a mensagem persistente (não é perdida em caso de crash do servidor)
+            body=self.encode(message),  # Converte o dicionário Python para uma string JSON
+            properties=self.persistent_properties  # delivery_mode=2 torna a mensagem persistente (não é perdida em caso de crash do servidor)
         )
 
-    # Inicia o consumo de mensagens da fila com o callback fornecido
-    def consume(self, queue_name, callback):
+    # Publica várias mensagens com publisher confirms, mantendo no máximo
+    # `window` mensagens sem confirmação ao mesmo tempo.
+    # Retorna a lista de mensagens recusadas (nack) pelo broker.
+    def publish_batch(self, queue_name, messages, window=256, timeout=30):
+        channel = self.enable_confirms()
+        deadline = time.monotonic() + timeout
+        self.nacked = []
+
+        for message in messages:
+            channel.basic_publish(
+                exchange='',
+                routing_key=queue_name,
+                body=self.encode(message),
+                properties=self.persistent_properties
+            )
+            self.unconfirmed[self.next_delivery_tag] = message
+            self.next_delivery_tag += 1
+            if len(self.unconfirmed) >= window:
+                self.wait_for_confirms(window // 2, deadline)
+
+        self.wait_for_confirms(1, deadline)
+        return self.nacked
+
+    # Ativa o modo confirm em um canal separado. O BlockingChannel do pika
+    # espera o ack de cada mensagem antes de retornar, então o modo confirm é
+    # ligado no canal interno (_impl) e os acks são contados em on_confirm.
+    def enable_confirms(self):
+        if self.confirm_channel is None:
+            # Canal dedicado: um canal em modo confirm não volta para o pool
+            channel = self.connection.channel()
+            selected = []
+            channel._impl.confirm_delivery(
+                ack_nack_callback=self.on_confirm,
+                callback=self.on_select_ok(selected)
+            )
+            while not selected:
+                self.connection.process_data_events(time_limit=1)
+            self.confirm_channel = channel
+        return self.confirm_channel
+
+    # O Confirm.SelectOk chega pelo canal interno e não acorda o
+    # process_data_events da BlockingConnection, que esperaria o time_limit
+    # inteiro; o timer de 0s faz a espera terminar assim que ele chega
+    def on_select_ok(self, selected):
+        def callback(frame):
+            selected.append(frame)
+            self.connection.call_later(0, _noop)
+        return callback
+
+    # Callback do broker: Basic.Ack/Basic.Nack, possivelmente cumulativo (multiple)
+    def on_confirm(self, frame):
+        method = frame.method
+        nack = isinstance(method, pika.spec.Basic.Nack)
+        if method.multiple:
+            while self.unconfirmed:
+                tag = next(iter(self.unconfirmed))
+                if tag > method.delivery_tag:
+                    break
+                message = self.unconfirmed.pop(tag)
+                if nack:
+                    self.nacked.append(message)
+        else:
+            message = self.unconfirmed.pop(method.delivery_tag, None)
+            if nack and message is not None:
+                self.nacked.append(message)
+
+        if len(self.unconfirmed) < self.wake_below:
+            # Agenda um evento para que process_data_events retorne já
+            self.wake_below = -1
+            self.connection.call_later(0, _noop)
+
+    # Processa eventos até restarem menos de `below` mensagens sem confirmação
+    def wait_for_confirms(self, below, deadline):
+        while len(self.unconfirmed) >= below:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"{len(self.unconfirmed)} mensagens sem confirmação do broker")
+            self.wake_below = below
+            self.connection.process_data_events(time_limit=remaining)
+
+    # Inicia o consumo de mensagens da fila com o callback fornecido.
+    # prefetch_count controla quantas mensagens o broker entrega sem ack;
+    # ack_batch_size/ack_interval_ms ativam a confirmação cumulativa (BatchAcker).
+    def consume(self, queue_name, callback, prefetch_count=1, ack_batch_size=1, ack_interval_ms=0):
+        acker = BatchAcker(self.connection, self.channel, prefetch_count, ack_batch_size, ack_interval_ms)
+
         # Função interna para adaptar o callback do pika (padrão) ao formato do usuário
         def wrapped_callback(ch, method, properties, body):
-            message = json.loads(body.decode())  # Decodifica JSON recebido
-            callback(message)                    # Executa o callback definido pelo usuário com a mensagem
-            ch.basic_ack(delivery_tag=method.delivery_tag)  # Confirma recebimento da mensagem (evita redelivery)
+            try:
+                message = json.loads(body.decode())  # Decodifica JSON recebido
+            except ValueError:
+                acker.nack(method.delivery_tag, requeue=False)  # Mensagem inválida nunca será processada
+                return
+            try:
+                callback(message)                # Executa o callback definido pelo usuário com a mensagem
+            except Exception:
+                acker.nack(method.delivery_tag)  # Devolve a mensagem para a fila
+                raise
+            acker.ack(method.delivery_tag)       # Confirma recebimento (imediato ou em lote)
 
-        # Configura para o consumidor receber apenas uma mensagem por vez (boa prática)
-        self.channel.basic_qos(prefetch_count=1)
+        # Quantas mensagens o consumidor pode receber antes de confirmar (1 = uma por vez)
+        self.channel.basic_qos(prefetch_count=prefetch_count)
 
         # Inscreve o consumidor com o callback tratado
         self.channel.basic_consume(queue=queue_name, on_message_callback=wrapped_callback)
 
         # Inicia o consumo de mensagens (bloqueia o processo até KeyboardInterrupt)
-        self.channel.start_consuming()
+        try:
+            self.channel.start_consuming()
+        finally:
+            if self.connection.is_open:
+                acker.flush()
         
     def close(self):
-        self.connection.close()
+        if self.confirm_channel is not None and self.confirm_channel.is_open:
+            self.confirm_channel.close()
+            self.confirm_channel = None
+        if self.owns_pool:
+            self.pool.close()
+        else:
+            self.pool.release(self.channel)
+
+
+# Intervalo usado quando um lote maior que 1 vem sem interval_ms: sem ele, um
+# lote incompleto só seria confirmado quando chegasse a próxima mensagem
+DEFAULT_ACK_INTERVAL_MS = 100
+
+
+# Confirma entregas de forma cumulativa (basic_ack com multiple=True) a cada
+# `batch_size` mensagens ou a cada `interval_ms` milissegundos, o que vier
+# primeiro. Deve ser usado na thread da conexão, como os callbacks do pika.
+class BatchAcker:
+    def __init__(self, connection, channel, prefetch_count=1, batch_size=1, interval_ms=0):
+        self.connection = connection
+        self.channel = channel
+        # Um lote maior que o prefetch nunca se completaria (o broker para de entregar)
+        if prefetch_count:
+            batch_size = min(batch_size, prefetch_count)
+        self.batch_size = max(batch_size, 1)
+        if self.batch_size > 1 and not interval_ms:
+            interval_ms = DEFAULT_ACK_INTERVAL_MS
+        self.interval = interval_ms / 1000.0
+        self.last_tag = None   # maior delivery_tag processado e ainda não confirmado
+        self.unacked = 0
+        self.timer = None
+
+    def ack(self, delivery_tag):
+        self.last_tag = delivery_tag
+        self.unacked += 1
+        if self.unacked >= self.batch_size:
+            self.flush()
+        elif self.interval and self.timer is None:
+            self.timer = self.connection.call_later(self.interval, self.on_timer)
+
+    def nack(self, delivery_tag, requeue=True):
+        # Confirma antes o que já foi processado, para o multiple=True não
+        # alcançar a mensagem que falhou
+        self.flush()
+        self.channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+
+    def on_timer(self):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.connection.remove_timeout(self.timer)
+            self.timer = None
+        if self.unacked:
+            self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+            self.unacked = 0
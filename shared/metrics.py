@@ -0,0 +1,196 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Métricas em memória no formato de texto do Prometheus.
+# Cada atualização é O(1) (histograma: busca binária nos limites) sob um lock
+# curto; o texto só é montado quando alguém consulta /metrics.
+
+# Limites padrão dos histogramas de tempo, em segundos
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """Série com os valores de label informados (criada no primeiro uso)"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, _labels(self.labelnames, values)))
+        return lines
+
+
+class _CounterValue:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, labels):
+        return [f"{name}{labels} {self.value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class _GaugeValue:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, labels):
+        value = self.function() if self.function is not None else self.value
+        return [f"{name}{labels} {value}"]
+
+
+class Gauge(_Metric):
+    """Valor instantâneo; com `function`, é calculado na hora da consulta"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self._default = self.labels()
+            self._default.function = function
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._default.set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # o último é o +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name, labels):
+        inner = labels[1:-1] + "," if labels else ""
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{{inner}le="{le}"}} {total}')
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {total}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        return self._register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def start_http_server(registry, port, host="0.0.0.0"):
+    """Expõe GET /metrics em uma thread separada; retorna o servidor"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Sem uma linha de log por consulta
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
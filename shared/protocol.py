@@ -1,26 +1,273 @@
+import json
+import struct
+import time
+import uuid
+from collections import namedtuple
+from threading import Lock
+from datetime import datetime, timedelta, timezone
+
 # Tipos de mensagens possíveis (valores fixos para padronizar a comunicação)
 ACQUIRE = "ACQUIRE"    # Pedido para entrar na seção crítica
 RELEASE = "RELEASE"    # Liberação da seção crítica
 COMMITTED = "COMMITTED"  # Confirmação de que a operação foi concluída com sucesso
+RENEW = "RENEW"        # Renovação do lease de uma concessão mantida pelo cliente
+REJECTED = "REJECTED"  # Pedido recusado por sobrecarga; tente de novo após retry_after_ms
+
+# Recurso usado quando o pedido não informa nenhum (a seção crítica global original)
+DEFAULT_RESOURCE = "default"
+
+# Modos de concessão do ACQUIRE: pedidos compartilhados (leitura) podem ter a
+# seção crítica ao mesmo tempo; um exclusivo (escrita) a tem sozinho
+EXCLUSIVE = "exclusive"
+SHARED = "shared"
+
+# Tipos que identificam um pedido e por isso exigem request_id
+_REQUEST_TYPES = (ACQUIRE, RELEASE, RENEW)
+
+
+# Marca de tempo atual em microssegundos desde a época (UTC)
+def now_us():
+    return time.time_ns() // 1000
+
+
+# Relógio lógico de Lamport: não depende do relógio de parede dos containers.
+# tick() antes de enviar; observe() ao receber uma mensagem com relógio.
+class LamportClock:
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def tick(self):
+        with self._lock:
+            self.value += 1
+            return self.value
+
+    def observe(self, remote):
+        with self._lock:
+            self.value = max(self.value, remote) + 1
+            return self.value
 
-# Classe que representa uma mensagem trocada entre processos
-class Message:
-    def __init__(self, msg_type, sender_id, timestamp=None):
-        # Inicializa uma nova mensagem com tipo, identificador do remetente e um timestamp opcional
-        self.type = msg_type      # Tipo da mensagem: ACQUIRE, RELEASE ou COMMITTED
-        self.sender = sender_id   # ID de quem enviou a mensagem
-        self.timestamp = timestamp  # Marca de tempo associada à mensagem (pode ser usada para ordenação)
 
-    # Converte o objeto Message em um dicionário Python para envio como JSON
+_MessageFields = namedtuple(
+    "_MessageFields",
+    ("type", "sender", "timestamp", "request_id", "resource", "lease_ms", "clock", "priority", "mode", "retry_after_ms"),
+    defaults=(None, None, None, 0, 0, 0, EXCLUSIVE, 0)
+)
+
+
+# Classe que representa uma mensagem trocada entre processos.
+# É uma tupla nomeada: imutável e sem __dict__ por instância, o que reduz a
+# memória dos pedidos pendentes. Para "alterar" um campo use _replace().
+#   type: ACQUIRE, RELEASE ou COMMITTED
+#   sender: ID de quem enviou a mensagem (client_id ou SYNC_ID)
+#   timestamp: microssegundos desde a época (pode ser usada para ordenação)
+#   request_id: UUID (string) do pedido ao qual a mensagem se refere
+#   resource: chave do recurso protegido; cada recurso tem sua própria fila
+#   lease_ms: duração do lease pedido/concedido (0 = o cluster_sync executa a seção)
+#   clock: relógio de Lamport do remetente (0 = sem relógio)
+#   priority: classe de prioridade do pedido (maior = mais urgente)
+#   mode: EXCLUSIVE (padrão) ou SHARED
+#   retry_after_ms: no REJECTED, quanto esperar antes de pedir de novo
+class Message(_MessageFields):
+    __slots__ = ()
+
+    # Converte o objeto Message no dicionário usado no protocolo JSON
+    # (mesmos campos que os clientes e o cluster_sync sempre trocaram)
     def to_dict(self):
-        return {
-            "type": self.type,
-            "sender": self.sender,
-            "timestamp": self.timestamp
+        data = {
+            "client_id": self.sender,
+            "request_id": self.request_id,
+            "timestamp": _format_timestamp(self.timestamp)
         }
+        if self.resource is not None:
+            data["resource"] = self.resource
+        if self.lease_ms:
+            data["lease_ms"] = self.lease_ms
+        if self.clock:
+            data["clock"] = self.clock
+        if self.priority:
+            data["priority"] = self.priority
+        if self.mode == SHARED:
+            data["mode"] = self.mode
+        if self.retry_after_ms:
+            data["retry_after_ms"] = self.retry_after_ms
+        if self.type in (COMMITTED, REJECTED):
+            data["status"] = self.type
+        else:
+            data["primitiva"] = self.type
+        return data
 
     # Método estático para criar um objeto Message a partir de um dicionário
     @staticmethod
     def from_dict(data):
-        # Pega os campos do dicionário recebido e cria uma nova instância de Message
-        return Message(data['type'], data['sender'], data.get('timestamp'))
+        # Respostas usam "status"; pedidos usam "primitiva"
+        msg_type = data.get("primitiva") or data.get("status")
+        mode = data.get("mode", EXCLUSIVE)
+        if mode not in (EXCLUSIVE, SHARED):
+            raise ValueError(f"Modo inválido: {mode}")
+        request_id = _str_field(data, "request_id")
+        _check_request_id(msg_type, request_id)
+        return Message(
+            msg_type,
+            _str_field(data, "client_id"),
+            _parse_timestamp(data.get("timestamp")),
+            request_id,
+            _str_field(data, "resource"),
+            _int_field(data, "lease_ms"),
+            _int_field(data, "clock"),
+            _int_field(data, "priority"),
+            mode,
+            _int_field(data, "retry_after_ms")
+        )
+
+
+# Campos numéricos do JSON: o heap de concessão compara prioridade e relógio,
+# então um valor de outro tipo é recusado aqui, antes de chegar à fila
+def _int_field(data, key):
+    value = data.get(key, 0)
+    if type(value) is not int:
+        raise ValueError(f"Campo {key} deve ser inteiro: {value!r}")
+    return value
+
+
+# Campos de texto opcionais: o client_id também entra na ordem do heap
+def _str_field(data, key):
+    value = data.get(key)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"Campo {key} deve ser texto: {value!r}")
+    return value
+
+
+# Sem request_id, pedidos diferentes colidiriam na mesma chave de deduplicação
+def _check_request_id(msg_type, request_id):
+    if msg_type in _REQUEST_TYPES and not request_id:
+        raise ValueError(f"{msg_type} sem request_id")
+
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+# Timestamps viajam no JSON como ISO 8601 em UTC (datetime.utcnow().isoformat())
+def _format_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return (_EPOCH + timestamp * _MICROSECOND).isoformat()
+
+
+def _parse_timestamp(value):
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError(f"Timestamp inválido: {value!r}")
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return (parsed - _EPOCH) // _MICROSECOND
+
+
+# Codec JSON: compatível com o formato original das mensagens
+class JsonCodec:
+    name = "json"
+    content_type = "application/json"
+
+    def __init__(self):
+        self._encode = json.JSONEncoder(separators=(',', ':')).encode
+
+    def encode(self, message):
+        return self._encode(message.to_dict()).encode()
+
+    def decode(self, body):
+        return Message.from_dict(json.loads(body))
+
+
+# Codec binário de layout fixo:
+#   versão (1 byte) | tipo (1 byte) | request_id (16 bytes, UUID) |
+#   timestamp (8 bytes, µs) | tamanho do remetente (1 byte) |
+#   tamanho do recurso (1 byte) | lease em ms (4 bytes) |
+#   relógio de Lamport (8 bytes) | prioridade (1 byte) | modo (1 byte) |
+#   retry_after em ms (4 bytes) |
+#   remetente (UTF-8) | recurso (UTF-8)
+# Remetente e recurso vão até 255 bytes e a prioridade de 0 a 255; encode
+# recusa com ValueError o que não cabe no layout.
+class BinaryCodec:
+    name = "binary"
+    content_type = "application/x-sync-message"
+
+    VERSION = 6
+    HEADER = struct.Struct("!BB16sqBBIQBBI")
+    TYPE_CODES = {ACQUIRE: 1, RELEASE: 2, COMMITTED: 3, RENEW: 4, REJECTED: 5}
+    TYPES = {code: msg_type for msg_type, code in TYPE_CODES.items()}
+    MODE_CODES = {EXCLUSIVE: 0, SHARED: 1}
+    MODES = {code: mode for mode, code in MODE_CODES.items()}
+    MAX_FIELD_BYTES = 255
+    MAX_PRIORITY = 255
+
+    def encode(self, message):
+        sender = (message.sender or "").encode()
+        resource = (message.resource or "").encode()
+        if len(sender) > self.MAX_FIELD_BYTES or len(resource) > self.MAX_FIELD_BYTES:
+            raise ValueError(f"Remetente e recurso devem ter até {self.MAX_FIELD_BYTES} bytes no codec binário")
+        if not 0 <= (message.priority or 0) <= self.MAX_PRIORITY:
+            raise ValueError(f"Prioridade fora de 0..{self.MAX_PRIORITY}: {message.priority}")
+        if message.type not in self.TYPE_CODES or message.mode not in self.MODE_CODES:
+            raise ValueError(f"Tipo ou modo sem código binário: {message.type}, {message.mode}")
+        request_id = uuid.UUID(message.request_id).bytes if message.request_id else bytes(16)
+        try:
+            header = self.HEADER.pack(
+                self.VERSION,
+                self.TYPE_CODES[message.type],
+                request_id,
+                message.timestamp or 0,
+                len(sender),
+                len(resource),
+                message.lease_ms or 0,
+                message.clock or 0,
+                message.priority or 0,
+                self.MODE_CODES[message.mode],
+                message.retry_after_ms or 0
+            )
+        except struct.error as e:
+            # lease_ms, relógio ou retry_after fora do tamanho do campo
+            raise ValueError(f"Mensagem não cabe no formato binário: {e}")
+        return header + sender + resource
+
+    def decode(self, body):
+        try:
+            (version, type_code, request_id, timestamp, sender_len, resource_len,
+             lease_ms, clock, priority, mode, retry_after_ms) = self.HEADER.unpack_from(body)
+        except struct.error as e:
+            raise ValueError(f"Mensagem binária inválida: {e}")
+        if version != self.VERSION or type_code not in self.TYPES or mode not in self.MODES:
+            raise ValueError(f"Mensagem binária inválida (versão {version}, tipo {type_code})")
+        # Decodifica direto do corpo recebido (bytes ou memoryview), sem cópias intermediárias
+        offset = self.HEADER.size
+        sender = str(body[offset:offset + sender_len], "utf-8")
+        offset += sender_len
+        resource = str(body[offset:offset + resource_len], "utf-8")
+        msg_type = self.TYPES[type_code]
+        request_id = str(uuid.UUID(bytes=request_id)) if any(request_id) else None
+        _check_request_id(msg_type, request_id)
+        return Message(
+            msg_type,
+            sender or None,
+            timestamp or None,
+            request_id,
+            resource or None,
+            lease_ms,
+            clock,
+            priority,
+            self.MODES[mode],
+            retry_after_ms
+        )
+
+
+# Codecs disponíveis, indexados pelo content_type do AMQP e pelo nome
+CODECS = {codec.content_type: codec for codec in (JsonCodec(), BinaryCodec())}
+CODECS_BY_NAME = {codec.name: codec for codec in CODECS.values()}
+DEFAULT_CODEC = CODECS_BY_NAME["json"]
+
+
+# Escolhe o codec a partir do content_type recebido (JSON se ausente/desconhecido)
+def get_codec(content_type):
+    return CODECS.get(content_type, DEFAULT_CODEC)
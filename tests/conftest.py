@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Os serviços importam o pacote `shared` da raiz e os módulos do cluster_sync
+# pelo nome (grant_queue, wal, ...), como em `PYTHONPATH=. python cluster_sync/src/...`
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "cluster_sync", "src")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
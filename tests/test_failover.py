@@ -0,0 +1,115 @@
+import threading
+import time
+import uuid
+
+import pika
+import pytest
+
+import cluster_sync
+from shared.memory_broker import MemoryBroker
+from shared.protocol import ACQUIRE, COMMITTED, RELEASE, CODECS_BY_NAME, Message, now_us
+
+CODEC = CODECS_BY_NAME["json"]
+
+
+@pytest.fixture
+def replicated(monkeypatch):
+    monkeypatch.setenv("SYNC_EVENTS_EXCHANGE", "sync_events")
+    monkeypatch.setenv("LEASE_TIMEOUT_MS", "300")
+    monkeypatch.setenv("HEARTBEAT_INTERVAL_MS", "50")
+    monkeypatch.setenv("RECONNECT_MAX_MS", "100")
+    monkeypatch.setenv("LOG_LEVEL", "WARNING")
+    for name in ("WAL_DIR", "SHARD_EXCHANGE", "MAX_PENDING", "MAX_WAIT_MS"):
+        monkeypatch.delenv(name, raising=False)
+
+    broker = MemoryBroker()
+    nodes = {}
+    for sync_id in ("sync_1", "sync_2"):
+        monkeypatch.setenv("SYNC_ID", sync_id)
+        transport = broker.node()
+        sync = cluster_sync.ClusterSync(transport=transport)
+        sync.pool.backoff_base = sync.pool.backoff_max = 0.05
+        threading.Thread(target=sync.run, daemon=True).start()
+        nodes[sync_id] = (sync, transport)
+    yield broker, nodes
+    for _, transport in nodes.values():
+        transport.down()
+
+
+class LeaseClient:
+    """Cliente mínimo: ACQUIRE com lease, espera o COMMITTED e envia RELEASE"""
+
+    def __init__(self, broker):
+        self.connection = broker.connect()
+        self.channel = self.connection.channel()
+        self.reply_queue = self.channel.queue_declare(queue="", exclusive=True).method.queue
+        self.replies = {}
+        self.channel.basic_consume(queue=self.reply_queue, on_message_callback=self.on_reply, auto_ack=True)
+
+    def on_reply(self, ch, method, properties, body):
+        self.replies[properties.correlation_id] = CODEC.decode(body)
+
+    def publish(self, message, correlation_id=None):
+        self.channel.basic_publish(
+            exchange="", routing_key="r_queue", body=CODEC.encode(message),
+            properties=pika.BasicProperties(
+                content_type=CODEC.content_type, reply_to=self.reply_queue, correlation_id=correlation_id
+            )
+        )
+
+    def acquire_release(self, timeout):
+        request_id, correlation_id = str(uuid.uuid4()), str(uuid.uuid4())
+        self.publish(Message(ACQUIRE, "client", now_us(), request_id, None, 5000), correlation_id)
+        deadline = time.monotonic() + timeout
+        while correlation_id not in self.replies and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.02)
+        reply = self.replies.pop(correlation_id, None)
+        if reply is None or reply.type != COMMITTED:
+            return False
+        self.publish(Message(RELEASE, "client", now_us(), request_id))
+        return True
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def leaders(nodes):
+    return [sync_id for sync_id, (sync, _) in nodes.items() if sync.is_leader]
+
+
+def test_commits_continue_after_leader_goes_down(replicated):
+    broker, nodes = replicated
+    assert wait_for(lambda: len(leaders(nodes)) == 1, 3)
+    old_leader = leaders(nodes)[0]
+
+    client = LeaseClient(broker)
+    for _ in range(5):
+        assert client.acquire_release(timeout=2)
+
+    nodes[old_leader][1].down()
+    assert wait_for(lambda: leaders(nodes) not in ([], [old_leader]), 3)
+    new_leader = leaders(nodes)[-1]
+    assert new_leader != old_leader and nodes[new_leader][0].lease.term == 2
+    for _ in range(5):
+        assert client.acquire_release(timeout=2)
+
+
+def test_dropped_leader_stops_granting_until_reelected(replicated):
+    broker, nodes = replicated
+    assert wait_for(lambda: len(leaders(nodes)) == 1, 3)
+    old_leader = leaders(nodes)[0]
+
+    nodes[old_leader][1].drop()  # volta na hora, mas precisa de uma nova eleição
+    assert wait_for(lambda: not nodes[old_leader][0].is_leader, 1)
+    assert wait_for(lambda: len(leaders(nodes)) == 1, 3)
+
+    client = LeaseClient(broker)
+    for _ in range(5):
+        assert client.acquire_release(timeout=2)
+    assert len(broker.queues["r_queue"].consumers) == 1
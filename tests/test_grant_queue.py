@@ -0,0 +1,111 @@
+from grant_queue import GrantQueue, PendingRequest, RecentIds
+from shared.protocol import ACQUIRE, EXCLUSIVE, SHARED, Message
+
+
+def request(request_id, sender="c", clock=1, priority=0, mode=EXCLUSIVE):
+    message = Message(ACQUIRE, sender, 1, request_id, "r", 0, clock, priority, mode)
+    return PendingRequest(message, None, None, None)
+
+
+def add(queue, request_id, **kwargs):
+    return queue.add(request_id, request(request_id, **kwargs))
+
+
+def granted(queue, held_mode=None):
+    return [r.message.request_id for r in queue.grant_batch(held_mode)]
+
+
+def test_orders_by_priority_then_clock():
+    queue = GrantQueue()
+    add(queue, "late", sender="a", clock=5)
+    add(queue, "early", sender="b", clock=2)
+    add(queue, "urgent", sender="c", clock=9, priority=1)
+    order = []
+    while queue:
+        batch = granted(queue)
+        order += batch
+        queue.release(batch[0])
+    assert order == ["urgent", "early", "late"]
+
+
+def test_one_request_per_client_per_round():
+    queue = GrantQueue()
+    for i in range(3):
+        add(queue, f"a{i}", sender="a", clock=i + 1)
+    add(queue, "b0", sender="b", clock=10)
+    order = []
+    while queue:
+        batch = granted(queue)
+        order += batch
+        queue.release(batch[0])
+    assert order == ["a0", "b0", "a1", "a2"]
+
+
+def test_duplicates_are_ignored_after_release():
+    recent = RecentIds()
+    queue = GrantQueue(recent)
+    assert add(queue, "x")
+    assert not add(queue, "x")
+    queue.release("x")
+    # Outra fila com o mesmo conjunto também reconhece o id concluído
+    assert not add(GrantQueue(recent), "x")
+
+
+def test_recent_ids_are_bounded():
+    recent = RecentIds(limit=2)
+    for request_id in ("a", "b", "c"):
+        recent.add(request_id)
+    assert "a" not in recent and "c" in recent
+
+
+def test_shared_requests_are_granted_together():
+    queue = GrantQueue()
+    add(queue, "s1", sender="a", clock=1, mode=SHARED)
+    add(queue, "s2", sender="b", clock=2, mode=SHARED)
+    add(queue, "w", sender="c", clock=3)
+    assert granted(queue) == ["s1", "s2"]
+    assert granted(queue, SHARED) == []
+    queue.release("s1")
+    queue.release("s2")
+    assert granted(queue) == ["w"]
+
+
+def test_shared_limit_lets_waiting_exclusive_through():
+    queue = GrantQueue(shared_limit=1)
+    add(queue, "s1", sender="a", clock=1, mode=SHARED)
+    add(queue, "w", sender="b", clock=2)
+    add(queue, "s2", sender="c", clock=1, mode=SHARED)
+    assert granted(queue) == ["s1"]
+    queue.release("s1")
+    assert granted(queue) == ["w"]
+
+
+def test_released_waiting_exclusive_resets_bypass_count():
+    queue = GrantQueue(shared_limit=2)
+    add(queue, "s0", sender="a", clock=1, mode=SHARED)
+    add(queue, "w", sender="b", clock=5)
+    assert granted(queue) == ["s0"]
+    queue.release("w")
+    add(queue, "w2", sender="c", clock=50)
+    add(queue, "s1", sender="d", clock=2, mode=SHARED)
+    add(queue, "s2", sender="e", clock=3, mode=SHARED)
+    assert granted(queue, SHARED) == ["s1", "s2"]
+
+
+def test_requeue_granted_returns_grants_to_the_queue():
+    queue = GrantQueue()
+    add(queue, "x")
+    assert granted(queue) == ["x"]
+    queue.requeue_granted()
+    assert granted(queue) == ["x"]
+
+
+def test_mark_granted():
+    queue = GrantQueue()
+    add(queue, "x")
+    add(queue, "y", clock=2)
+    assert queue.mark_granted("x").message.request_id == "x"
+    assert queue.mark_granted("x") is None
+    assert granted(queue, EXCLUSIVE) == []
+    queue.release("x")
+    assert granted(queue) == ["y"]
@@ -0,0 +1,78 @@
+from leases import LeaseTable
+from replication import LeaderLease
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lease_expires_after_duration():
+    clock = FakeClock()
+    leases = LeaseTable(clock)
+    leases.grant("r", "a", 1.0)
+    leases.grant("r", "b", 2.0)
+    assert leases.next_deadline() == 1.0
+    clock.now = 1.5
+    assert leases.expire() == [("r", "a")]
+    assert len(leases) == 1
+
+
+def test_renew_extends_and_dropped_lease_cannot_be_renewed():
+    clock = FakeClock()
+    leases = LeaseTable(clock)
+    leases.grant("r", "a", 1.0)
+    clock.now = 0.8
+    assert leases.renew("r", "a", 1.0)
+    clock.now = 1.5
+    assert leases.expire() == []
+    assert leases.next_deadline() == 1.8
+    leases.drop("r", "a")
+    assert not leases.renew("r", "a", 1.0)
+    assert leases.next_deadline() is None
+
+
+def run(clock, nodes, links, steps):
+    for _ in range(steps):
+        clock.now += 0.1
+        for sender, receiver in links:
+            receiver.observe(sender.node_id, sender.is_leader, sender.term)
+        for node in nodes:
+            node.update()
+
+
+def test_lowest_id_is_elected_after_listening():
+    clock = FakeClock()
+    a, b = LeaderLease("a", 0.3, clock), LeaderLease("b", 0.3, clock)
+    run(clock, [a, b], [(a, b), (b, a)], 2)
+    assert a.leader is None and b.leader is None  # ainda ouvindo a rede
+    run(clock, [a, b], [(a, b), (b, a)], 4)
+    assert a.is_leader and b.leader == "a"
+    assert a.term == b.term == 1
+
+
+def test_stale_leader_yields_to_higher_term():
+    clock = FakeClock()
+    a, b = LeaderLease("a", 0.3, clock), LeaderLease("b", 0.3, clock)
+    run(clock, [a, b], [(a, b), (b, a)], 6)
+    # Partição: b deixa de ouvir a e assume com um termo maior
+    run(clock, [a, b], [], 6)
+    assert a.is_leader and b.is_leader and b.term == 2
+    # a volta ainda se declarando líder, mas o menor id não basta
+    run(clock, [a, b], [(a, b), (b, a)], 2)
+    assert a.leader == b.leader == "b"
+
+
+def test_reset_listens_a_full_lease_before_claiming():
+    clock = FakeClock()
+    a = LeaderLease("a", 0.3, clock)
+    run(clock, [a], [], 5)
+    assert a.is_leader
+    a.reset()
+    run(clock, [a], [], 1)
+    assert a.leader is None
+    run(clock, [a], [], 4)
+    assert a.is_leader and a.term == 2
@@ -0,0 +1,94 @@
+import os
+import uuid
+
+import pytest
+
+import cluster_sync
+from grant_queue import PendingRequest
+from shared.memory_broker import MemoryBroker
+from shared.protocol import ACQUIRE, CODECS_BY_NAME, Message
+from wal import ACQUIRE_RECORD, GRANT_RECORD, RELEASE_RECORD, MAX_FIELD_BYTES, WriteAheadLog, encode_acquire
+
+
+def request(codec="json", lease_ms=0, resource="r"):
+    message = Message(ACQUIRE, "c", 1, str(uuid.uuid4()), resource, lease_ms, 1)
+    return PendingRequest(message, "reply", "corr", CODECS_BY_NAME[codec])
+
+
+def records(directory):
+    return list(WriteAheadLog(str(directory), lambda: []).replay())
+
+
+def test_replays_records_in_order(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), lambda: [])
+    wal.start()
+    first, second = request(), request("binary")
+    wal.append_acquire(first)
+    wal.append_acquire(second)
+    wal.append_grant("r", first.message.request_id)
+    wal.append_release("r", first.message.request_id)
+    wal.close()
+
+    replayed = records(tmp_path)
+    assert [record[0] for record in replayed] == [ACQUIRE_RECORD, ACQUIRE_RECORD, GRANT_RECORD, RELEASE_RECORD]
+    assert replayed[0][1].message == first.message
+    assert replayed[1][1].message == second.message
+    assert replayed[1][1].reply_to == "reply"
+    assert replayed[3][1:] == ("r", first.message.request_id)
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), lambda: [])
+    wal.start()
+    kept = request()
+    wal.append_acquire(kept)
+    wal.append_acquire(request())
+    wal.close()
+    segment = max(name for name in os.listdir(tmp_path) if name.startswith("wal-"))
+    path = os.path.join(tmp_path, segment)
+    os.truncate(path, os.path.getsize(path) - 3)  # queda no meio da escrita
+
+    replayed = records(tmp_path)
+    assert [record[1].message for record in replayed] == [kept.message]
+
+
+def test_snapshot_keeps_pending_and_granted(tmp_path):
+    pending = [request(lease_ms=500), request()]
+    pending[0].granted_at = 1.0
+    wal = WriteAheadLog(str(tmp_path), lambda: pending)
+    wal.start()
+    wal.append_release("r", "finished")
+    wal.flush()
+    wal._rotate(wal._segment_number + 1)  # troca de segmento: snapshot e compactação
+    wal.close()
+
+    replayed = records(tmp_path)
+    assert [record[0] for record in replayed] == [ACQUIRE_RECORD, GRANT_RECORD, ACQUIRE_RECORD]
+    assert replayed[1][1:] == ("r", pending[0].message.request_id)
+
+
+def test_after_flush_runs_after_fsync(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), lambda: [])
+    wal.start()
+    done = []
+    wal.append_acquire(request())
+    wal.after_flush(lambda: done.append(len(records(tmp_path))))
+    wal.flush()
+    wal.close()
+    assert done == [1]
+
+
+def test_oversized_acquire_is_refused_before_queueing(tmp_path, monkeypatch):
+    with pytest.raises(ValueError):
+        encode_acquire(request(resource="r" * MAX_FIELD_BYTES))
+
+    monkeypatch.setenv("WAL_DIR", str(tmp_path))
+    for name in ("SYNC_EVENTS_EXCHANGE", "SHARD_EXCHANGE", "METRICS_PORT"):
+        monkeypatch.delenv(name, raising=False)
+    sync = cluster_sync.ClusterSync(transport=MemoryBroker())
+    try:
+        with pytest.raises(ValueError):
+            sync.add_request(request(resource="r" * MAX_FIELD_BYTES))
+        assert sync.grant_queues == {}
+    finally:
+        sync.wal.close()